@@ -1,17 +1,28 @@
 import os
 import logging
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
 import secrets
-import requests
 import time
 import asyncio
 import sys
 import json
+import signal
+import random
+import threading
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager, nullcontext
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
-from threading import Thread
+import httpx
+import tornado.web
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+from telegram.request import HTTPXRequest
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
 
 # Configure logging
 logging.basicConfig(
@@ -19,6 +30,16 @@ logging.basicConfig(
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
+# httpx logs every request URL at INFO, and Bot API URLs contain the token.
+logging.getLogger('httpx').setLevel(logging.WARNING)
+
+# Cold-start bookkeeping: handlers wait on startup_ready until the schema
+# check and warm-ups are done; per-phase durations land in startup_timings.
+STARTUP_STARTED = time.monotonic()
+startup_ready = asyncio.Event()
+startup_timings = {}
+# Set on SIGTERM/SIGINT before anything is torn down.
+shutting_down = asyncio.Event()
 
 # Bot configuration
 BOT_TOKEN = os.getenv("BOT_TOKEN", "YOUR_TOKEN_HERE")
@@ -26,15 +47,123 @@ DATABASE_URL = os.getenv("DATABASE_URL")  # PostgreSQL connection string
 ADMIN_ID = 829342319  # <--- REPLACE with your actual Admin ID
 LINK_EXPIRY_MINUTES = 5
 
+# Database connection pool
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', 1))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', 10))
+DB_POOL_CHECKOUT_TIMEOUT = float(os.environ.get('DB_POOL_CHECKOUT_TIMEOUT', 10))
+DB_POOL_HEALTHCHECK_INTERVAL = float(os.environ.get('DB_POOL_HEALTHCHECK_INTERVAL', 30))
+DB_EXECUTOR_WORKERS = int(os.environ.get('DB_EXECUTOR_WORKERS', DB_POOL_MAX_SIZE))
+DB_POOL_WARM_SIZE = int(os.environ.get('DB_POOL_WARM_SIZE', 4))
+
+# In-process caches (seconds)
+FORCE_SUB_CACHE_TTL = int(os.environ.get('FORCE_SUB_CACHE_TTL', 300))
+MEMBERSHIP_CACHE_MEMBER_TTL = int(os.environ.get('MEMBERSHIP_CACHE_MEMBER_TTL', 600))
+MEMBERSHIP_CACHE_NON_MEMBER_TTL = int(os.environ.get('MEMBERSHIP_CACHE_NON_MEMBER_TTL', 30))
+MEMBERSHIP_CACHE_MAX_ENTRIES = int(os.environ.get('MEMBERSHIP_CACHE_MAX_ENTRIES', 50000))
+LINK_INFO_CACHE_SIZE = int(os.environ.get('LINK_INFO_CACHE_SIZE', 10000))
+CHANNEL_INFO_CACHE_SIZE = int(os.environ.get('CHANNEL_INFO_CACHE_SIZE', 1000))
+CHANNEL_INFO_CACHE_TTL = int(os.environ.get('CHANNEL_INFO_CACHE_TTL', 3600))
+USER_COUNTERS_CACHE_TTL = int(os.environ.get('USER_COUNTERS_CACHE_TTL', 5))
+
+# Invite links are reused while they have more than INVITE_LINK_MIN_REMAINING
+# seconds left and rotated in the background below INVITE_LINK_REFRESH_REMAINING.
+INVITE_LINK_MIN_REMAINING = int(os.environ.get('INVITE_LINK_MIN_REMAINING', 90))
+INVITE_LINK_REFRESH_REMAINING = int(os.environ.get('INVITE_LINK_REFRESH_REMAINING', 150))
+INVITE_LINK_ROTATION_INTERVAL = int(os.environ.get('INVITE_LINK_ROTATION_INTERVAL', 30))
+INVITE_LINK_MAX_BACKOFF = int(os.environ.get('INVITE_LINK_MAX_BACKOFF', 1800))
+
+# Force-sub membership checks
+MEMBERSHIP_CHECK_TIMEOUT = float(os.environ.get('MEMBERSHIP_CHECK_TIMEOUT', 5))
+MEMBERSHIP_CHECK_CONCURRENCY = int(os.environ.get('MEMBERSHIP_CHECK_CONCURRENCY', 10))
+
+# How often the in-memory ban list is reloaded from the DB (seconds)
+BAN_LIST_RECONCILE_INTERVAL = int(os.environ.get('BAN_LIST_RECONCILE_INTERVAL', 900))
+
+# Expired-link retention and the cleanup sweeper (seconds unless noted)
+LINK_RETENTION_DAYS = int(os.environ.get('LINK_RETENTION_DAYS', 7))
+CLEANUP_INTERVAL = int(os.environ.get('CLEANUP_INTERVAL', 600))
+CLEANUP_MIN_INTERVAL = int(os.environ.get('CLEANUP_MIN_INTERVAL', 60))
+CLEANUP_BATCH_SIZE = int(os.environ.get('CLEANUP_BATCH_SIZE', 1000))
+CLEANUP_MAX_BATCHES = int(os.environ.get('CLEANUP_MAX_BATCHES', 50))
+CLEANUP_BATCH_PAUSE = float(os.environ.get('CLEANUP_BATCH_PAUSE', 0.2))
+
+# Write-behind user upserts
+USER_UPSERT_BATCH_SIZE = int(os.environ.get('USER_UPSERT_BATCH_SIZE', 200))
+USER_UPSERT_FLUSH_INTERVAL = float(os.environ.get('USER_UPSERT_FLUSH_INTERVAL', 5))
+USER_UPSERT_RECENT_PROFILES = int(os.environ.get('USER_UPSERT_RECENT_PROFILES', 50000))
+
 # --- NEW BROADCAST THROTTLING CONSTANTS ---
 BROADCAST_CHUNK_SIZE = 1000
 BROADCAST_MIN_USERS = 5000
-BROADCAST_INTERVAL_MIN = 20
+BROADCAST_INTERVAL_MIN = int(os.environ.get('BROADCAST_INTERVAL_MIN', 0))
+BROADCAST_PAGE_SIZE = 500
+
+# Broadcast engine: global send rate (msg/s), concurrent senders, retries
+BROADCAST_RATE_LIMIT = float(os.environ.get('BROADCAST_RATE_LIMIT', 28))
+BROADCAST_WORKERS = int(os.environ.get('BROADCAST_WORKERS', 16))
+BROADCAST_PER_CHAT_INTERVAL = float(os.environ.get('BROADCAST_PER_CHAT_INTERVAL', 1))
+BROADCAST_MAX_RETRIES = int(os.environ.get('BROADCAST_MAX_RETRIES', 3))
+# Flood waits (429) are not failures: they are retried after Telegram's
+# delay and only give up past this many for one chat.
+BROADCAST_MAX_FLOOD_WAITS = int(os.environ.get('BROADCAST_MAX_FLOOD_WAITS', 50))
+BROADCAST_RETRY_BASE_DELAY = float(os.environ.get('BROADCAST_RETRY_BASE_DELAY', 1))
+BROADCAST_CHECKPOINT_INTERVAL = float(os.environ.get('BROADCAST_CHECKPOINT_INTERVAL', 2))
+BROADCAST_STATUS_EDIT_INTERVAL = float(os.environ.get('BROADCAST_STATUS_EDIT_INTERVAL', 5))
+# A campaign run that crashes (e.g. the DB went away) is retried after this
+# delay, doubling per consecutive failure up to BROADCAST_FAILURE_MAX_BACKOFF.
+BROADCAST_FAILURE_BACKOFF = float(os.environ.get('BROADCAST_FAILURE_BACKOFF', 30))
+BROADCAST_FAILURE_MAX_BACKOFF = float(os.environ.get('BROADCAST_FAILURE_MAX_BACKOFF', 900))
+
+# Updates from different users run concurrently, up to UPDATE_CONCURRENCY at
+# once; one user's updates always run in order.
+UPDATE_CONCURRENCY = int(os.environ.get('UPDATE_CONCURRENCY', 16))
+UPDATE_PER_USER_MAX_PENDING = int(os.environ.get('UPDATE_PER_USER_MAX_PENDING', 20))
+
+# Scale-out mode. 'standalone' is one process doing everything. 'ingress'
+# only accepts webhooks and queues updates in Postgres; each 'worker'
+# consumes shard WORKER_SHARD of WORKER_SHARDS (sharded by user ID) and the
+# workers elect one leader to run the periodic jobs.
+BOT_ROLE = os.environ.get('BOT_ROLE', 'standalone')
+WORKER_SHARDS = int(os.environ.get('WORKER_SHARDS', 1))
+WORKER_SHARD = int(os.environ.get('WORKER_SHARD', 0))
+SHARED_QUEUE_BATCH_SIZE = int(os.environ.get('SHARED_QUEUE_BATCH_SIZE', 100))
+SHARED_QUEUE_MIN_POLL_INTERVAL = float(os.environ.get('SHARED_QUEUE_MIN_POLL_INTERVAL', 0.05))
+SHARED_QUEUE_MAX_POLL_INTERVAL = float(os.environ.get('SHARED_QUEUE_MAX_POLL_INTERVAL', 1))
+LEADER_ELECTION_INTERVAL = float(os.environ.get('LEADER_ELECTION_INTERVAL', 15))
+BROADCAST_POLL_INTERVAL = float(os.environ.get('BROADCAST_POLL_INTERVAL', 5))
+# Workers tell each other about ban, channel and reachability changes over
+# this Postgres NOTIFY channel.
+CACHE_INVALIDATION_CHANNEL = os.environ.get('CACHE_INVALIDATION_CHANNEL', 'bot_cache_invalidation')
 # ------------------------------------------
 
 # Webhook / polling config
 PORT = int(os.environ.get('PORT', 8080))
 WEBHOOK_URL = os.environ.get('RENDER_EXTERNAL_URL', '').rstrip('/') + '/'
+# Resent webhook updates are dropped by update_id. The seen IDs are saved to
+# UPDATE_DEDUP_FILE on shutdown (empty disables). With WEBHOOK_FAST_ACK=1 the
+# webhook answers 200 before the update is queued.
+UPDATE_DEDUP_CAPACITY = int(os.environ.get('UPDATE_DEDUP_CAPACITY', 10000))
+UPDATE_DEDUP_FILE = os.environ.get('UPDATE_DEDUP_FILE', 'seen_updates.json')
+WEBHOOK_FAST_ACK = os.environ.get('WEBHOOK_FAST_ACK', '0') == '1'
+
+# Health checks and keep-alive. /healthz and /readyz are served next to the
+# webhook. The DB and Bot API are checked every HEALTH_CHECK_INTERVAL; when
+# RENDER_EXTERNAL_URL is set and no request has come in for the keep-alive
+# interval, the bot pings its own /healthz so the platform doesn't idle it out.
+# The interval grows while pings are fast and halves when one is slow or
+# fails, between KEEP_ALIVE_MIN_INTERVAL and KEEP_ALIVE_MAX_INTERVAL.
+HEALTHZ_PATH = '/healthz'
+READYZ_PATH = '/readyz'
+SELF_PING_URL = os.environ.get('RENDER_EXTERNAL_URL', '').rstrip('/')
+HEALTH_CHECK_INTERVAL = float(os.environ.get('HEALTH_CHECK_INTERVAL', 60))
+HEALTH_CHECK_TIMEOUT = float(os.environ.get('HEALTH_CHECK_TIMEOUT', 10))
+KEEP_ALIVE_INTERVAL = float(os.environ.get('KEEP_ALIVE_INTERVAL', 600))
+KEEP_ALIVE_MIN_INTERVAL = float(os.environ.get('KEEP_ALIVE_MIN_INTERVAL', 60))
+KEEP_ALIVE_MAX_INTERVAL = float(os.environ.get('KEEP_ALIVE_MAX_INTERVAL', 840))
+KEEP_ALIVE_SLOW_PING = float(os.environ.get('KEEP_ALIVE_SLOW_PING', 5))
+# A shutdown after at least this long without requests is taken as an idle
+# spin-down; the next start keeps its pings under 80% of that idle time.
+IDLE_SHUTDOWN_MIN_SECONDS = float(os.environ.get('IDLE_SHUTDOWN_MIN_SECONDS', 300))
 
 # Customization constants
 WELCOME_SOURCE_CHANNEL = -1002530952988
@@ -45,7 +174,540 @@ ADMIN_CONTACT_USERNAME = "Beat_Anime_Ocean"
 
 # User states
 ADD_CHANNEL_USERNAME, ADD_CHANNEL_TITLE, GENERATE_LINK_CHANNEL_USERNAME, PENDING_BROADCAST = range(4)
-user_states = {}
+# Admin flow state lives in conversation_store ('postgres' or 'memory');
+# a flow left untouched for CONVERSATION_STATE_TTL seconds is dropped.
+CONVERSATION_STORE_BACKEND = os.environ.get('CONVERSATION_STORE', 'postgres')
+CONVERSATION_STATE_TTL = int(os.environ.get('CONVERSATION_STATE_TTL', 1800))
+
+# ========== METRICS ==========
+
+METRICS_PATH = '/metrics'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class MetricsRegistry:
+    """In-process counters and latency histograms, rendered in Prometheus text format.
+
+    Collectors registered with add_collector() are called at scrape time and
+    return (name, type, labels, value) samples for state that lives elsewhere
+    (cache hit counters, pool stats), so nothing has to be mirrored here.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist[0][i] += 1
+            hist[1] += value
+            hist[2] += 1
+
+    @contextmanager
+    def timer(self, name, error_counter=None, **labels):
+        """Observes the duration of the block; counts `error_counter` if it raises."""
+        start = time.monotonic()
+        try:
+            yield
+        except Exception:
+            if error_counter:
+                self.inc(error_counter, **labels)
+            raise
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (
+            (k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in pairs
+        )
+        return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+    def render(self):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (list(h[0]), h[1], h[2])) for key, h in self._histograms.items())
+
+        families = {}
+        for (name, labels), value in counters:
+            families.setdefault(name, ('counter', []))[1].append((labels, value))
+        for collector in self._collectors:
+            try:
+                for name, kind, labels, value in collector():
+                    _, sample_labels = self._key(name, labels)
+                    families.setdefault(name, (kind, []))[1].append((sample_labels, value))
+            except Exception as e:
+                logger.warning(f"Metrics collector {getattr(collector, '__name__', collector)} failed: {e}")
+
+        lines = []
+        for name, (kind, samples) in families.items():
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{self._format_labels(labels)} {value}")
+
+        last_name = None
+        for (name, labels), (bucket_counts, total, count) in histograms:
+            if name != last_name:
+                lines.append(f"# TYPE {name} histogram")
+                last_name = name
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                lines.append(f"{name}_bucket{self._format_labels(labels, [('le', str(bound))])} {bucket_count}")
+            lines.append(f"{name}_bucket{self._format_labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{self._format_labels(labels)} {total:.6f}")
+            lines.append(f"{name}_count{self._format_labels(labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+
+ADMIN_STATE_METRIC_NAMES = {
+    ADD_CHANNEL_USERNAME: 'add_channel_username',
+    ADD_CHANNEL_TITLE: 'add_channel_title',
+    GENERATE_LINK_CHANNEL_USERNAME: 'generate_link_channel_username',
+    PENDING_BROADCAST: 'pending_broadcast',
+}
+
+def handler_metric_label(func, update):
+    """Names the code path an update takes: command or callback route.
+
+    Admin flow messages are split by state inside handle_admin_message.
+    """
+    if isinstance(update, Update):
+        if update.callback_query and update.callback_query.data is not None:
+            # Labelled by route, never the raw payload, to keep ids out of label values.
+            route, _ = callback_router.resolve(update.callback_query.data)
+            return f"callback:{route.name if route else 'unrouted'}"
+        message = update.effective_message
+        if message and message.text and message.text.startswith('/'):
+            command = message.text.split()[0].split('@')[0]
+            return f"command:{command}"
+    return func.__name__
+
+def instrument_handler(func):
+    """Wraps a handler callback with latency and error metrics."""
+    @wraps(func)
+    async def wrapper(update, context):
+        with metrics.timer('handler_latency_seconds', 'handler_errors_total',
+                           handler=handler_metric_label(func, update)):
+            return await func(update, context)
+    return wrapper
+
+class InstrumentedHTTPXRequest(HTTPXRequest):
+    """HTTPXRequest that times every Bot API call and counts 429s and failures."""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        start = time.monotonic()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception as e:
+            metrics.inc('telegram_api_errors_total', method=api_method, reason=type(e).__name__)
+            raise
+        finally:
+            metrics.observe('telegram_api_latency_seconds', time.monotonic() - start, method=api_method)
+        if code == 429:
+            metrics.inc('telegram_rate_limited_total', method=api_method)
+        elif code >= 400:
+            metrics.inc('telegram_api_errors_total', method=api_method, reason=str(code))
+        return code, payload
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(metrics.render())
+
+class UpdateDeduplicator:
+    """Remembers the last `capacity` update_ids seen at the webhook.
+
+    A ring buffer keeps the eviction order and a set answers lookups in O(1).
+    Telegram resends an update when our response is slow; the resend carries
+    the same update_id and is dropped here before any handler runs.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._ring = deque()
+        self._seen = set()
+        self.duplicates = 0
+
+    def check_and_add(self, update_id):
+        """Returns True the first time an update_id is seen, False for a resend."""
+        if update_id in self._seen:
+            self.duplicates += 1
+            return False
+        if len(self._ring) >= self.capacity:
+            self._seen.discard(self._ring.popleft())
+        self._ring.append(update_id)
+        self._seen.add(update_id)
+        return True
+
+    def __len__(self):
+        return len(self._seen)
+
+    def forget(self, update_id):
+        """Lets a retry through after an update could not be queued."""
+        self._seen.discard(update_id)
+
+    def load(self, path):
+        try:
+            with open(path, 'r') as f:
+                update_ids = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not load seen update IDs from {path}: {e}")
+            return
+        for update_id in update_ids[-self.capacity:]:
+            self.check_and_add(update_id)
+        logger.info(f"Loaded {len(self._ring)} seen update IDs from {path}.")
+
+    def save(self, path):
+        try:
+            with open(path, 'w') as f:
+                json.dump(list(self._ring), f)
+        except OSError as e:
+            logger.warning(f"Could not save seen update IDs to {path}: {e}")
+
+update_deduplicator = UpdateDeduplicator(UPDATE_DEDUP_CAPACITY)
+# Strong references to fast-ack enqueue tasks until they finish.
+webhook_tasks = set()
+
+class TelegramWebhookHandler(tornado.web.RequestHandler):
+    """Accepts webhook POSTs from Telegram and hands each update to `enqueue`.
+
+    `enqueue(update, payload)` gets the parsed Update and the raw JSON dict:
+    the local application queue in standalone mode, the shared Postgres
+    queue on an ingress. Duplicates are dropped first. In fast-ack mode the
+    response goes out before `enqueue` runs, so a failed enqueue loses the
+    update; otherwise it returns 500 and Telegram retries.
+    """
+
+    def initialize(self, bot, enqueue, deduplicator=None, fast_ack=False):
+        self.bot = bot
+        self.enqueue = enqueue
+        self.deduplicator = deduplicator
+        self.fast_ack = fast_ack
+
+    def log_exception(self, typ, value, tb):
+        # Tornado's default message includes the request path, i.e. the bot token.
+        if isinstance(value, tornado.web.HTTPError):
+            return
+        logger.error(f"Webhook request failed: {value!r}", exc_info=(typ, value, tb))
+
+    async def post(self):
+        health_monitor.note_request()
+        try:
+            payload = json.loads(self.request.body)
+            update = Update.de_json(payload, self.bot)
+        except Exception as e:
+            logger.warning(f"Rejected malformed webhook payload: {e}")
+            raise tornado.web.HTTPError(400)
+        if self.deduplicator is not None and not self.deduplicator.check_and_add(update.update_id):
+            metrics.inc('webhook_duplicates_dropped_total')
+            return
+        metrics.inc('webhook_updates_total')
+
+        if self.fast_ack:
+            task = asyncio.create_task(self.enqueue(update, payload))
+            webhook_tasks.add(task)
+            task.add_done_callback(self.enqueue_done)
+            return
+        try:
+            await self.enqueue(update, payload)
+        except Exception:
+            if self.deduplicator is not None:
+                self.deduplicator.forget(update.update_id)
+            raise
+
+    @staticmethod
+    def enqueue_done(task):
+        webhook_tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            metrics.inc('webhook_enqueue_errors_total')
+            logger.error(f"Fast-ack update could not be queued: {task.exception()}")
+
+def build_http_app(webhook_path=None, bot=None, enqueue=None):
+    """Routes /metrics, /healthz and /readyz, plus the webhook path when running behind a webhook."""
+    routes = [
+        (METRICS_PATH, MetricsHandler),
+        (HEALTHZ_PATH, HealthHandler),
+        (READYZ_PATH, ReadyHandler),
+    ]
+    if webhook_path:
+        routes.append((webhook_path, TelegramWebhookHandler, {
+            'bot': bot, 'enqueue': enqueue,
+            'deduplicator': update_deduplicator, 'fast_ack': WEBHOOK_FAST_ACK,
+        }))
+    return HTTPApplication(routes)
+
+class HTTPApplication(tornado.web.Application):
+    """Tornado app whose access log never shows the webhook path.
+
+    The webhook route is /<BOT_TOKEN>, so tornado's default access line would
+    write the token to the logs on every update. Successful webhook requests
+    are not logged (as with PTB's own webhook server); failures are logged
+    with the path redacted.
+    """
+
+    def log_request(self, handler):
+        if not isinstance(handler, TelegramWebhookHandler):
+            super().log_request(handler)
+            return
+        status = handler.get_status()
+        if status >= 400:
+            request_time = 1000.0 * handler.request.request_time()
+            logger.warning(f"Webhook request failed: {status} {handler.request.method} <webhook> {request_time:.2f}ms")
+
+def collect_runtime_metrics():
+    """Scrape-time samples for caches, the DB pool, the upsert queue, invite links and roles."""
+    caches = {
+        'force_sub_channels': force_sub_channel_cache,
+        'membership': membership_cache,
+        'link_info': link_info_cache,
+        'channel_info': channel_info_cache,
+        'user_counters': user_counters_cache,
+    }
+    for name, cache in caches.items():
+        yield 'cache_hits_total', 'counter', {'cache': name}, cache.hits
+        yield 'cache_misses_total', 'counter', {'cache': name}, cache.misses
+
+    pool = db_pool.stats()
+    yield 'db_pool_connections_in_use', 'gauge', {}, pool['in_use']
+    yield 'db_pool_waiting', 'gauge', {}, pool['waiting']
+    yield 'db_pool_max_size', 'gauge', {}, pool['max_size']
+    yield 'db_pool_checkout_timeouts_total', 'counter', {}, pool['timeouts']
+    yield 'db_pool_reconnects_total', 'counter', {}, pool['reconnects']
+
+    yield 'user_upsert_pending', 'gauge', {}, len(user_upsert_queue.pending)
+    yield 'user_upsert_rows_written_total', 'counter', {}, user_upsert_queue.rows_written
+    yield 'invite_links_created_total', 'counter', {}, invite_link_pool.created
+    yield 'invite_links_reused_total', 'counter', {}, invite_link_pool.reused
+    yield 'invite_link_errors_total', 'counter', {}, invite_link_pool.errors
+    yield 'broadcasts_active', 'gauge', {}, len(active_broadcasts)
+    yield 'webhook_dedup_tracked', 'gauge', {}, len(update_deduplicator)
+    for phase, seconds in startup_timings.items():
+        yield 'startup_phase_seconds', 'gauge', {'phase': phase}, round(seconds, 6)
+    yield 'updates_waiting', 'gauge', {}, update_processor.waiting
+    yield 'updates_running', 'gauge', {}, update_processor.running
+    if leader_lock is not None:
+        yield 'worker_is_leader', 'gauge', {}, int(leader_lock.held)
+        yield 'worker_owns_shard', 'gauge', {'shard': WORKER_SHARD}, int(shard_lock.held)
+
+metrics.add_collector(collect_runtime_metrics)
+
+# ========== HEALTH / KEEP-ALIVE ==========
+
+class HealthMonitor:
+    """Runs the DB and Bot API health checks and self-pings /healthz after a quiet interval."""
+
+    IDLE_SHUTDOWN_KEY = 'idle_shutdown_after'
+
+    def __init__(self, ping_url, interval, min_interval, max_interval, slow_ping):
+        self.ping_url = ping_url
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min(max(interval, min_interval), max_interval)
+        self.slow_ping = slow_ping
+        self.checks = {}
+        self.last_request = time.monotonic()
+        self.last_ping = 0.0
+
+    def note_request(self):
+        self.last_request = time.monotonic()
+
+    def idle_seconds(self):
+        return time.monotonic() - self.last_request
+
+    def ping_due_in(self):
+        """Seconds until the next self-ping; a failed ping also waits a full interval."""
+        return self.interval - (time.monotonic() - max(self.last_request, self.last_ping))
+
+    def apply_idle_observation(self, idle_after):
+        """Caps the ping interval below an idle time that ended in a spin-down."""
+        cap = max(self.min_interval, idle_after * 0.8)
+        if cap < self.max_interval:
+            self.max_interval = cap
+            self.interval = min(self.interval, cap)
+            logger.info(f"Keep-alive capped at {cap:.0f}s after an idle spin-down at {idle_after:.0f}s.")
+
+    async def run_check(self, name, coro):
+        started = time.monotonic()
+        try:
+            detail = await asyncio.wait_for(coro, HEALTH_CHECK_TIMEOUT)
+            ok, error = True, None
+        except Exception as e:
+            detail, ok, error = None, False, f"{type(e).__name__}: {e}"
+            logger.warning(f"Health check '{name}' failed: {error}")
+        self.checks[name] = {
+            'ok': ok,
+            'latency': round(time.monotonic() - started, 4),
+            'error': error,
+            'detail': detail,
+            'checked_at': time.monotonic(),
+        }
+        metrics.inc('health_checks_total', check=name, result='ok' if ok else 'error')
+
+    async def check_database(self):
+        await ping_database()
+        pool = db_pool.stats()
+        return {'in_use': pool['in_use'], 'waiting': pool['waiting'], 'max_size': pool['max_size']}
+
+    async def check_bot_api(self, bot):
+        me = await bot.get_me()
+        return {'username': me.username}
+
+    async def run_checks(self, bot):
+        await asyncio.gather(
+            self.run_check('database', self.check_database()),
+            self.run_check('bot_api', self.check_bot_api(bot)),
+        )
+
+    async def self_ping(self, client):
+        """GETs our own /healthz through the public URL and adapts the interval."""
+        started = time.monotonic()
+        try:
+            response = await client.get(self.ping_url + HEALTHZ_PATH, params={'keepalive': '1'})
+            ok = response.status_code == 200
+            reason = str(response.status_code)
+        except httpx.HTTPError as e:
+            ok, reason = False, type(e).__name__
+        latency = time.monotonic() - started
+        self.last_ping = time.monotonic()
+        metrics.observe('keep_alive_ping_seconds', latency)
+        if ok and latency < self.slow_ping:
+            metrics.inc('keep_alive_pings_total', result='ok')
+            self.interval = min(self.max_interval, self.interval * 1.25)
+        else:
+            metrics.inc('keep_alive_pings_total', result='ok' if ok else 'error')
+            self.interval = max(self.min_interval, self.interval / 2)
+            logger.warning(
+                f"Keep-alive ping {'slow' if ok else 'failed'} ({reason}, {latency:.1f}s); "
+                f"interval now {self.interval:.0f}s."
+            )
+
+    def is_ready(self):
+        """Ready once startup finished and the latest DB and Bot API checks passed recently."""
+        if not startup_ready.is_set():
+            return False
+        for name in ('database', 'bot_api'):
+            check = self.checks.get(name)
+            if check is None or not check['ok']:
+                return False
+            if time.monotonic() - check['checked_at'] > HEALTH_CHECK_INTERVAL * 3:
+                return False
+        return True
+
+    def report(self):
+        return {
+            'uptime': round(time.monotonic() - STARTUP_STARTED, 1),
+            'ready': self.is_ready(),
+            'role': BOT_ROLE,
+            'idle_seconds': round(self.idle_seconds(), 1),
+            'keep_alive_interval': round(self.interval, 1) if self.ping_url else None,
+            'checks': {
+                name: {k: v for k, v in check.items() if k != 'checked_at'}
+                for name, check in self.checks.items()
+            },
+        }
+
+    async def run(self, bot, stop_event):
+        """Health checks and keep-alive pings until stop_event is set; starts once startup is ready."""
+        await startup_ready.wait()
+        if self.ping_url:
+            try:
+                idle_after = await fetch_service_state(self.IDLE_SHUTDOWN_KEY)
+            except Exception as e:
+                logger.warning(f"Could not load the last idle spin-down time: {e}")
+                idle_after = None
+            if idle_after:
+                self.apply_idle_observation(float(idle_after))
+            logger.info(f"Keep-alive pinging {self.ping_url}{HEALTHZ_PATH} after {self.interval:.0f}s idle.")
+
+        next_check = 0.0
+        async with httpx.AsyncClient(timeout=HEALTH_CHECK_TIMEOUT) as client:
+            while not stop_event.is_set():
+                now = time.monotonic()
+                if now >= next_check:
+                    await self.run_checks(bot)
+                    next_check = time.monotonic() + HEALTH_CHECK_INTERVAL
+                if self.ping_url and self.ping_due_in() <= 0:
+                    await self.self_ping(client)
+                delay = next_check - time.monotonic()
+                if self.ping_url:
+                    delay = min(delay, self.ping_due_in())
+                try:
+                    await asyncio.wait_for(stop_event.wait(), max(delay, 1))
+                except asyncio.TimeoutError:
+                    pass
+
+    async def record_shutdown(self):
+        """Saves the idle time if this shutdown looks like an idle spin-down."""
+        idle = self.idle_seconds()
+        if not self.ping_url or not IDLE_SHUTDOWN_MIN_SECONDS <= idle < self.interval + HEALTH_CHECK_INTERVAL:
+            return
+        try:
+            await save_service_state(self.IDLE_SHUTDOWN_KEY, round(idle))
+            logger.info(f"Shut down after {idle:.0f}s without requests; recorded as an idle spin-down.")
+        except Exception as e:
+            logger.warning(f"Could not record the idle spin-down time: {e}")
+
+health_monitor = HealthMonitor(
+    SELF_PING_URL,
+    KEEP_ALIVE_INTERVAL,
+    KEEP_ALIVE_MIN_INTERVAL,
+    KEEP_ALIVE_MAX_INTERVAL,
+    KEEP_ALIVE_SLOW_PING,
+)
+
+class HealthHandler(tornado.web.RequestHandler):
+    """Liveness: 200 while the event loop is serving requests."""
+
+    def get(self):
+        if self.get_query_argument('keepalive', None):
+            health_monitor.note_request()
+        self.write({'status': 'ok', 'uptime': round(time.monotonic() - STARTUP_STARTED, 1)})
+
+class ReadyHandler(tornado.web.RequestHandler):
+    """Readiness: 200 once startup is done and the DB and Bot API answer, 503 otherwise."""
+
+    def get(self):
+        report = health_monitor.report()
+        if not report['ready']:
+            self.set_status(503)
+        self.write(report)
+
+def collect_health_metrics():
+    for name, check in health_monitor.checks.items():
+        yield 'health_check_ok', 'gauge', {'check': name}, int(check['ok'])
+        yield 'health_check_latency_seconds', 'gauge', {'check': name}, check['latency']
+    yield 'service_ready', 'gauge', {}, int(health_monitor.is_ready())
+    yield 'seconds_since_last_request', 'gauge', {}, round(health_monitor.idle_seconds(), 1)
+    if health_monitor.ping_url:
+        yield 'keep_alive_interval_seconds', 'gauge', {}, round(health_monitor.interval, 1)
+
+metrics.add_collector(collect_health_metrics)
 
 # ========== HELPER FUNCTION: AUTO-DELETE ==========
 
@@ -53,7 +715,7 @@ async def delete_update_message(update: Update, context: ContextTypes.DEFAULT_TY
     """Safely attempts to delete the message associated with the incoming update (user input)."""
     user_id = update.effective_user.id
     
-    if user_id == ADMIN_ID and user_states.get(user_id) == PENDING_BROADCAST:
+    if user_id == ADMIN_ID and await conversation_store.get_state(user_id) == PENDING_BROADCAST:
         return 
         
     if update.message:
@@ -63,8 +725,11 @@ async def delete_update_message(update: Update, context: ContextTypes.DEFAULT_TY
             logger.warning(f"Could not delete message for user {update.effective_user.id}: {e}")
 
 async def delete_bot_prompt(context: ContextTypes.DEFAULT_TYPE, chat_id):
-    """Safely attempts to delete the bot's stored prompt message."""
-    prompt_id = context.user_data.pop('bot_prompt_message_id', None)
+    """Safely attempts to delete the bot's stored prompt message.
+
+    Prompts are keyed by chat ID, which is the admin's user ID in a private chat.
+    """
+    prompt_id = await conversation_store.pop_prompt(chat_id)
     if prompt_id:
         try:
             await context.bot.delete_message(chat_id=chat_id, message_id=prompt_id)
@@ -74,55 +739,536 @@ async def delete_bot_prompt(context: ContextTypes.DEFAULT_TYPE, chat_id):
 
 # ========== DATABASE FUNCTIONS (PostgreSQL) ==========
 
+class DatabasePool:
+    """Thread-safe PostgreSQL connection pool shared by every DB helper.
+
+    Wraps psycopg2's ThreadedConnectionPool so callers block (up to a timeout)
+    instead of failing when all connections are checked out, replaces dead
+    connections on checkout and keeps simple usage metrics for /stats.
+    """
+
+    def __init__(self, dsn, minconn, maxconn, checkout_timeout, healthcheck_interval):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.checkout_timeout = checkout_timeout
+        self.healthcheck_interval = healthcheck_interval
+        self._pool = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._last_used = {}
+        self.in_use = 0
+        self.waiting = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.reconnects = 0
+        self.total_checkout_time = 0.0
+        self.max_checkout_time = 0.0
+
+    def _get_pool(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = psycopg2.pool.ThreadedConnectionPool(
+                        self.minconn, self.maxconn, self.dsn, sslmode='require'
+                    )
+        return self._pool
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        last_used = self._last_used.get(id(conn))
+        if last_used is not None and time.monotonic() - last_used < self.healthcheck_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return False
+
+    def getconn(self):
+        pool = self._get_pool()
+        start = time.monotonic()
+        with self._lock:
+            self.waiting += 1
+        acquired = self._slots.acquire(timeout=self.checkout_timeout)
+        with self._lock:
+            self.waiting -= 1
+        if not acquired:
+            with self._lock:
+                self.timeouts += 1
+            raise psycopg2.pool.PoolError(f"Timed out after {self.checkout_timeout}s waiting for a DB connection")
+
+        try:
+            # After a DB restart every idle connection is dead: keep discarding
+            # until a healthy one turns up. Once the idle ones are used up the
+            # pool opens fresh connections, so maxconn + 1 tries always suffice.
+            for _ in range(self.maxconn + 1):
+                conn = pool.getconn()
+                if self._is_healthy(conn):
+                    break
+                logger.warning("Discarding dead pooled DB connection and reconnecting.")
+                self._discard(pool, conn)
+                with self._lock:
+                    self.reconnects += 1
+            else:
+                raise psycopg2.OperationalError("Could not get a healthy DB connection")
+        except Exception:
+            self._slots.release()
+            raise
+
+        elapsed = time.monotonic() - start
+        with self._lock:
+            self.in_use += 1
+            self.checkouts += 1
+            self.total_checkout_time += elapsed
+            self.max_checkout_time = max(self.max_checkout_time, elapsed)
+        return conn
+
+    def putconn(self, conn, close=False):
+        pool = self._get_pool()
+        try:
+            if close or conn.closed:
+                self._discard(pool, conn)
+            else:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                self._last_used[id(conn)] = time.monotonic()
+                pool.putconn(conn)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self._discard(pool, conn)
+        finally:
+            with self._lock:
+                self.in_use -= 1
+            self._slots.release()
+
+    def _discard(self, pool, conn):
+        self._last_used.pop(id(conn), None)
+        try:
+            pool.putconn(conn, close=True)
+        except Exception as e:
+            logger.warning(f"Error closing pooled DB connection: {e}")
+
+    def warm(self, count):
+        """Opens up to `count` connections ahead of the first burst of traffic."""
+        conns = []
+        try:
+            for _ in range(min(count, self.maxconn)):
+                conns.append(self.getconn())
+        finally:
+            for conn in conns:
+                self.putconn(conn)
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection for the duration of a `with` block."""
+        conn = self.getconn()
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.putconn(conn, close=broken)
+
+    def stats(self):
+        with self._lock:
+            avg_ms = (self.total_checkout_time / self.checkouts * 1000) if self.checkouts else 0.0
+            return {
+                'min_size': self.minconn,
+                'max_size': self.maxconn,
+                'in_use': self.in_use,
+                'waiting': self.waiting,
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'reconnects': self.reconnects,
+                'avg_checkout_ms': avg_ms,
+                'max_checkout_ms': self.max_checkout_time * 1000,
+            }
+
+    def closeall(self):
+        with self._lock:
+            if self._pool is not None and not self._pool.closed:
+                self._pool.closeall()
+            self._pool = None
+            self._last_used.clear()
+
+db_pool = DatabasePool(
+    DATABASE_URL,
+    DB_POOL_MIN_SIZE,
+    DB_POOL_MAX_SIZE,
+    DB_POOL_CHECKOUT_TIMEOUT,
+    DB_POOL_HEALTHCHECK_INTERVAL,
+)
+
 def get_db_connection():
-    """Get PostgreSQL connection"""
-    return psycopg2.connect(DATABASE_URL, sslmode='require')
+    """Get a pooled PostgreSQL connection (use as a context manager)."""
+    return db_pool.connection()
 
-def init_db():
-    conn = get_db_connection()
+# Blocking psycopg2 calls run here so they never stall the bot's event loop.
+# Sized to the pool so worker threads don't queue on connection checkout.
+db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix='db')
+
+def run_in_db_executor(func):
+    """Turns a blocking DB helper into a coroutine run on the DB thread pool."""
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        queued_at = time.monotonic()
+
+        def timed_call():
+            metrics.observe('db_executor_wait_seconds', time.monotonic() - queued_at)
+            with metrics.timer('db_query_latency_seconds', 'db_errors_total', helper=func.__name__):
+                return func(*args, **kwargs)
+
+        return await loop.run_in_executor(db_executor, timed_call)
+    return wrapper
+
+# Keeps NOTIFY payloads well under Postgres' 8000-byte limit.
+NOTIFY_MAX_IDS = 500
+
+def notify_workers(cursor, kind, ids=()):
+    """Queues a cache invalidation for the other workers; it is sent when the transaction commits.
+
+    A no-op outside worker mode, where the in-memory state has one owner.
+    """
+    if BOT_ROLE != 'worker':
+        return
+    ids = list(ids)
+    if not ids:
+        cursor.execute('SELECT pg_notify(%s, %s)', (CACHE_INVALIDATION_CHANNEL, kind))
+    for i in range(0, len(ids), NOTIFY_MAX_IDS):
+        payload = f"{kind}:{','.join(str(x) for x in ids[i:i + NOTIFY_MAX_IDS])}"
+        cursor.execute('SELECT pg_notify(%s, %s)', (CACHE_INVALIDATION_CHANNEL, payload))
+
+# Versioned schema changes applied by run_migrations() at startup, in order.
+# `concurrent` migrations run outside a transaction so CREATE INDEX
+# CONCURRENTLY doesn't lock the table; if one fails, `cleanup` drops the
+# half-built (INVALID) index so the next start can retry it.
+SCHEMA_MIGRATIONS = [
+    {
+        'version': 1,
+        'name': 'users_unreachable_columns',
+        'statements': [
+            'ALTER TABLE users ADD COLUMN IF NOT EXISTS unreachable_reason TEXT',
+            'ALTER TABLE users ADD COLUMN IF NOT EXISTS unreachable_since TIMESTAMP',
+        ],
+    },
+    {
+        'version': 2,
+        'name': 'broadcast_campaign_status_columns',
+        'statements': [
+            'ALTER TABLE broadcast_campaigns ADD COLUMN IF NOT EXISTS blocked_count INTEGER DEFAULT 0',
+            'ALTER TABLE broadcast_campaigns ADD COLUMN IF NOT EXISTS total_estimate INTEGER DEFAULT 0',
+            'ALTER TABLE broadcast_campaigns ADD COLUMN IF NOT EXISTS status_message_id BIGINT',
+        ],
+    },
+    {
+        'version': 3,
+        'name': 'idx_users_lower_username',
+        'concurrent': True,
+        'statements': ['CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_lower_username ON users (LOWER(username))'],
+        'cleanup': ['DROP INDEX CONCURRENTLY IF EXISTS idx_users_lower_username'],
+    },
+    {
+        'version': 4,
+        'name': 'idx_users_joined_date',
+        'concurrent': True,
+        'statements': ['CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_joined_date ON users (joined_date DESC)'],
+        'cleanup': ['DROP INDEX CONCURRENTLY IF EXISTS idx_users_joined_date'],
+    },
+    {
+        'version': 5,
+        'name': 'idx_users_banned',
+        'concurrent': True,
+        'statements': ['CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_banned ON users (user_id) WHERE is_banned = TRUE'],
+        'cleanup': ['DROP INDEX CONCURRENTLY IF EXISTS idx_users_banned'],
+    },
+    {
+        'version': 6,
+        'name': 'idx_generated_links_expiring',
+        'concurrent': True,
+        'statements': [
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_generated_links_expiring '
+            'ON generated_links (created_time) WHERE never_expires = FALSE'
+        ],
+        'cleanup': ['DROP INDEX CONCURRENTLY IF EXISTS idx_generated_links_expiring'],
+    },
+    {
+        'version': 7,
+        'name': 'idx_force_sub_channels_active_title',
+        'concurrent': True,
+        'statements': [
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_force_sub_channels_active_title '
+            'ON force_sub_channels (channel_title) WHERE is_active = TRUE'
+        ],
+        'cleanup': ['DROP INDEX CONCURRENTLY IF EXISTS idx_force_sub_channels_active_title'],
+    },
+    {
+        'version': 8,
+        'name': 'user_counters',
+        'statements': [
+            '''
+            CREATE TABLE IF NOT EXISTS user_counters (
+                name TEXT PRIMARY KEY,
+                value BIGINT NOT NULL DEFAULT 0
+            )
+            ''',
+            '''
+            CREATE OR REPLACE FUNCTION maintain_user_counters() RETURNS trigger AS $$
+            DECLARE
+                d_total INTEGER := 0;
+                d_active INTEGER := 0;
+                d_banned INTEGER := 0;
+                d_unreachable INTEGER := 0;
+            BEGIN
+                IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                    d_total := d_total + 1;
+                    IF COALESCE(NEW.is_banned, FALSE) THEN d_banned := d_banned + 1; END IF;
+                    IF NEW.unreachable_since IS NOT NULL THEN d_unreachable := d_unreachable + 1; END IF;
+                    IF NOT COALESCE(NEW.is_banned, FALSE) AND NEW.unreachable_since IS NULL THEN d_active := d_active + 1; END IF;
+                END IF;
+                IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                    d_total := d_total - 1;
+                    IF COALESCE(OLD.is_banned, FALSE) THEN d_banned := d_banned - 1; END IF;
+                    IF OLD.unreachable_since IS NOT NULL THEN d_unreachable := d_unreachable - 1; END IF;
+                    IF NOT COALESCE(OLD.is_banned, FALSE) AND OLD.unreachable_since IS NULL THEN d_active := d_active - 1; END IF;
+                END IF;
+                -- Profile-only upserts change nothing; skip the counter rows entirely.
+                IF d_total = 0 AND d_active = 0 AND d_banned = 0 AND d_unreachable = 0 THEN
+                    RETURN NULL;
+                END IF;
+                UPDATE user_counters SET value = value + CASE name
+                    WHEN 'total' THEN d_total
+                    WHEN 'active' THEN d_active
+                    WHEN 'banned' THEN d_banned
+                    WHEN 'unreachable' THEN d_unreachable
+                END
+                WHERE name IN ('total', 'active', 'banned', 'unreachable');
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            ''',
+            'LOCK TABLE users IN SHARE ROW EXCLUSIVE MODE',
+            'DROP TRIGGER IF EXISTS users_maintain_counters ON users',
+            '''
+            CREATE TRIGGER users_maintain_counters
+            AFTER INSERT OR DELETE OR UPDATE OF is_banned, unreachable_since ON users
+            FOR EACH ROW EXECUTE FUNCTION maintain_user_counters()
+            ''',
+            '''
+            INSERT INTO user_counters (name, value)
+            SELECT 'total', COUNT(*) FROM users
+            UNION ALL SELECT 'active', COUNT(*) FROM users WHERE NOT COALESCE(is_banned, FALSE) AND unreachable_since IS NULL
+            UNION ALL SELECT 'banned', COUNT(*) FROM users WHERE COALESCE(is_banned, FALSE)
+            UNION ALL SELECT 'unreachable', COUNT(*) FROM users WHERE unreachable_since IS NOT NULL
+            ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value
+            ''',
+        ],
+    },
+    {
+        'version': 9,
+        'name': 'conversation_states',
+        'statements': [
+            '''
+            CREATE TABLE IF NOT EXISTS conversation_states (
+                user_id BIGINT PRIMARY KEY,
+                state INTEGER,
+                prompt_message_id BIGINT,
+                data JSONB NOT NULL DEFAULT '{}',
+                expires_at TIMESTAMP NOT NULL
+            )
+            ''',
+            'CREATE INDEX IF NOT EXISTS idx_conversation_states_expires_at ON conversation_states (expires_at)',
+        ],
+    },
+    {
+        'version': 10,
+        'name': 'update_queue',
+        'statements': [
+            '''
+            CREATE TABLE IF NOT EXISTS update_queue (
+                update_id BIGINT PRIMARY KEY,
+                shard INTEGER NOT NULL,
+                payload JSONB NOT NULL,
+                received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            ''',
+            'CREATE INDEX IF NOT EXISTS idx_update_queue_shard ON update_queue (shard, update_id)',
+        ],
+    },
+    {
+        'version': 11,
+        'name': 'service_state',
+        'statements': [
+            '''
+            CREATE TABLE IF NOT EXISTS service_state (
+                key TEXT PRIMARY KEY,
+                value JSONB NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            ''',
+        ],
+    },
+]
+
+# Arbitrary constant key for the advisory lock that serializes migration runs.
+MIGRATIONS_LOCK_ID = 7_301_415_001
+MIGRATIONS_LOCK_POLL_INTERVAL = 0.5
+MIGRATIONS_LOCK_TIMEOUT = 600
+
+def run_migrations(conn):
+    """Applies pending SCHEMA_MIGRATIONS and records them in schema_migrations.
+
+    Holds a session advisory lock so instances starting together don't race;
+    already-applied versions are skipped, so it is safe to run on every start.
+    """
+    # Waiting inside pg_advisory_lock would hold a snapshot that another
+    # instance's CREATE INDEX CONCURRENTLY waits on: a deadlock. Poll instead.
+    conn.autocommit = True
     cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id BIGINT PRIMARY KEY,
-            username TEXT,
-            first_name TEXT,
-            last_name TEXT,
-            joined_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            is_banned BOOLEAN DEFAULT FALSE
-        )
-    ''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS force_sub_channels (
-            channel_id SERIAL PRIMARY KEY,
-            channel_username TEXT UNIQUE,
-            channel_title TEXT,
-            added_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            is_active BOOLEAN DEFAULT TRUE
-        )
-    ''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS generated_links (
-            link_id TEXT PRIMARY KEY,
-            channel_username TEXT,
-            user_id BIGINT,
-            created_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            never_expires BOOLEAN DEFAULT FALSE
-        )
-    ''')
-    conn.commit()
-    conn.close()
+    try:
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        acquire_migrations_lock(cursor)
+        try:
+            cursor.execute('SELECT version FROM schema_migrations')
+            applied = {row[0] for row in cursor.fetchall()}
+            for migration in SCHEMA_MIGRATIONS:
+                if migration['version'] in applied:
+                    continue
+                start = time.monotonic()
+                if migration.get('concurrent'):
+                    apply_concurrent_migration(cursor, migration)
+                else:
+                    apply_transactional_migration(conn, migration)
+                logger.info(
+                    f"Applied migration {migration['version']} ({migration['name']}) "
+                    f"in {time.monotonic() - start:.2f}s"
+                )
+        finally:
+            cursor.execute('SELECT pg_advisory_unlock(%s)', (MIGRATIONS_LOCK_ID,))
+    finally:
+        conn.autocommit = False
 
+def acquire_migrations_lock(cursor):
+    """Takes MIGRATIONS_LOCK_ID, sleeping between tries so no statement stays open while waiting."""
+    deadline = time.monotonic() + MIGRATIONS_LOCK_TIMEOUT
+    waiting_logged = False
+    while True:
+        cursor.execute('SELECT pg_try_advisory_lock(%s)', (MIGRATIONS_LOCK_ID,))
+        if cursor.fetchone()[0]:
+            return
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"Migrations lock still held after {MIGRATIONS_LOCK_TIMEOUT}s")
+        if not waiting_logged:
+            logger.info("Another instance is running migrations; waiting.")
+            waiting_logged = True
+        time.sleep(MIGRATIONS_LOCK_POLL_INTERVAL)
+
+def record_migration(cursor, migration):
+    cursor.execute(
+        'INSERT INTO schema_migrations (version, name) VALUES (%s, %s) ON CONFLICT (version) DO NOTHING',
+        (migration['version'], migration['name'])
+    )
+
+def apply_transactional_migration(conn, migration):
+    conn.autocommit = False
+    try:
+        cursor = conn.cursor()
+        for statement in migration['statements']:
+            cursor.execute(statement)
+        record_migration(cursor, migration)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.autocommit = True
+
+def apply_concurrent_migration(cursor, migration):
+    try:
+        for statement in migration['statements']:
+            cursor.execute(statement)
+    except Exception:
+        for statement in migration.get('cleanup', []):
+            try:
+                cursor.execute(statement)
+            except Exception as e:
+                logger.error(f"Cleanup after failed migration {migration['version']} failed: {e}")
+        raise
+    record_migration(cursor, migration)
+
+def init_db():
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                user_id BIGINT PRIMARY KEY,
+                username TEXT,
+                first_name TEXT,
+                last_name TEXT,
+                joined_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                is_banned BOOLEAN DEFAULT FALSE
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS force_sub_channels (
+                channel_id SERIAL PRIMARY KEY,
+                channel_username TEXT UNIQUE,
+                channel_title TEXT,
+                added_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                is_active BOOLEAN DEFAULT TRUE
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS generated_links (
+                link_id TEXT PRIMARY KEY,
+                channel_username TEXT,
+                user_id BIGINT,
+                created_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                never_expires BOOLEAN DEFAULT FALSE
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_campaigns (
+                campaign_id SERIAL PRIMARY KEY,
+                admin_chat_id BIGINT,
+                message_chat_id BIGINT,
+                message_id BIGINT,
+                chunk_size INTEGER,
+                chunk_number INTEGER DEFAULT 1,
+                last_user_id BIGINT DEFAULT 0,
+                sent_count INTEGER DEFAULT 0,
+                failed_count INTEGER DEFAULT 0,
+                status TEXT DEFAULT 'running',
+                next_run_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        conn.commit()
+        run_migrations(conn)
+
+@run_in_db_executor
 def get_user_id_by_username(username):
     """Looks up a user's ID by their @username (case-insensitive)."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
     clean_username = username.lstrip('@').lower() 
-    cursor.execute('SELECT user_id FROM users WHERE LOWER(username) = %s', (clean_username,))
-    result = cursor.fetchone()
-    conn.close()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT user_id FROM users WHERE LOWER(username) = %s', (clean_username,))
+        result = cursor.fetchone()
     return result[0] if result else None
     
-def resolve_target_user_id(arg):
+async def resolve_target_user_id(arg):
     """Tries to resolve an argument (ID or @username) into a numerical user ID."""
     try:
         return int(arg)
@@ -130,225 +1276,1037 @@ def resolve_target_user_id(arg):
         pass
 
     if arg:
-        return get_user_id_by_username(arg)
+        # Someone who just sent /start may only be in the write-behind queue.
+        await user_upsert_queue.flush()
+        return await get_user_id_by_username(arg)
     
     return None
 
+@run_in_db_executor
 def ban_user(user_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET is_banned = TRUE WHERE user_id = %s', (user_id,))
-    conn.commit()
-    conn.close()
+    """Bans by ID, creating the row if the user's /start is still in the write-behind queue."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO users (user_id, is_banned) VALUES (%s, TRUE)
+            ON CONFLICT (user_id) DO UPDATE SET is_banned = TRUE
+        ''', (user_id,))
+        notify_workers(cursor, 'ban', [user_id])
+        conn.commit()
+    ban_list.add(user_id)
 
+@run_in_db_executor
 def unban_user(user_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET is_banned = FALSE WHERE user_id = %s', (user_id,))
-    conn.commit()
-    conn.close()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('UPDATE users SET is_banned = FALSE WHERE user_id = %s', (user_id,))
+        notify_workers(cursor, 'unban', [user_id])
+        conn.commit()
+    ban_list.discard(user_id)
 
-def is_user_banned(user_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT is_banned FROM users WHERE user_id = %s', (user_id,))
-    result = cursor.fetchone()
-    conn.close()
+@run_in_db_executor
+def fetch_is_user_banned(user_id):
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT is_banned FROM users WHERE user_id = %s', (user_id,))
+        result = cursor.fetchone()
     return result[0] if result else False
 
-def add_user(user_id, username, first_name, last_name):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    clean_username = username.lstrip('@') if username else None
-    cursor.execute('''
-        INSERT INTO users (user_id, username, first_name, last_name)
-        VALUES (%s, %s, %s, %s)
-        ON CONFLICT (user_id) 
-        DO UPDATE SET username = EXCLUDED.username, 
-                      first_name = EXCLUDED.first_name, 
-                      last_name = EXCLUDED.last_name
-    ''', (user_id, clean_username, first_name, last_name))
-    conn.commit()
-    conn.close()
-
-def get_user_count():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT COUNT(*) FROM users')
-    count = cursor.fetchone()[0]
-    conn.close()
-    return count
+async def is_user_banned(user_id):
+    """Answers from the in-memory ban list, falling back to the DB until it is loaded."""
+    if ban_list.loaded:
+        return user_id in ban_list
+    return await fetch_is_user_banned(user_id)
+
+@run_in_db_executor
+def load_banned_user_ids():
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT user_id FROM users WHERE is_banned = TRUE')
+        user_ids = [row[0] for row in cursor.fetchall()]
+    return user_ids
+
+@run_in_db_executor
+def upsert_users(rows):
+    """Writes [(user_id, username, first_name, last_name), ...] in one statement."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        psycopg2.extras.execute_values(cursor, '''
+            INSERT INTO users (user_id, username, first_name, last_name)
+            VALUES %s
+            ON CONFLICT (user_id) 
+            DO UPDATE SET username = EXCLUDED.username, 
+                          first_name = EXCLUDED.first_name, 
+                          last_name = EXCLUDED.last_name,
+                          unreachable_reason = NULL,
+                          unreachable_since = NULL
+        ''', rows, page_size=len(rows))
+        conn.commit()
+
+@run_in_db_executor
+def fetch_user_counters():
+    """Reads the trigger-maintained total/active/banned/unreachable user counts."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT name, value FROM user_counters')
+        counters = dict(cursor.fetchall())
+    return counters
+
+async def get_user_counters():
+    """User counters, cached for USER_COUNTERS_CACHE_TTL seconds."""
+    counters = user_counters_cache.get('counters')
+    if counters is None:
+        counters = await fetch_user_counters()
+        user_counters_cache.set('counters', counters)
+    return counters
+
+async def get_user_count(reachable_only=False):
+    """Total (or reachable, non-banned) user count without scanning users."""
+    counters = await get_user_counters()
+    return counters.get('active' if reachable_only else 'total', 0)
+
+@run_in_db_executor
+def mark_users_unreachable(reasons):
+    """Flags users whose chats permanently reject messages; takes {user_id: reason}."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        psycopg2.extras.execute_values(cursor, '''
+            UPDATE users SET unreachable_reason = data.reason, unreachable_since = CURRENT_TIMESTAMP
+            FROM (VALUES %s) AS data (user_id, reason)
+            WHERE users.user_id = data.user_id
+        ''', list(reasons.items()))
+        # Their shard's worker must write the next /start, which clears the flag.
+        notify_workers(cursor, 'forget_profiles', reasons)
+        conn.commit()
 
+@run_in_db_executor
 def get_all_users(limit=None, offset=0):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    if limit is None:
-        cursor.execute('SELECT user_id, username, first_name, last_name, joined_date, is_banned FROM users ORDER BY joined_date DESC')
-    else:
-        cursor.execute('SELECT user_id, username, first_name, last_name, joined_date, is_banned FROM users ORDER BY joined_date DESC LIMIT %s OFFSET %s', (limit, offset))
-    users = cursor.fetchall()
-    conn.close()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        if limit is None:
+            cursor.execute('SELECT user_id, username, first_name, last_name, joined_date, is_banned FROM users ORDER BY joined_date DESC')
+        else:
+            cursor.execute('SELECT user_id, username, first_name, last_name, joined_date, is_banned FROM users ORDER BY joined_date DESC LIMIT %s OFFSET %s', (limit, offset))
+        users = cursor.fetchall()
     return users
 
+@run_in_db_executor
+def get_broadcast_user_ids(after_user_id=0, limit=BROADCAST_PAGE_SIZE):
+    """Keyset page of reachable, non-banned user IDs ordered by user_id, starting after after_user_id."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            'SELECT user_id FROM users WHERE user_id > %s AND is_banned = FALSE AND unreachable_since IS NULL ORDER BY user_id LIMIT %s',
+            (after_user_id, limit)
+        )
+        user_ids = [row[0] for row in cursor.fetchall()]
+    return user_ids
+
+async def iter_broadcast_user_ids(after_user_id=0, limit=None, page_size=BROADCAST_PAGE_SIZE):
+    """Streams reachable, non-banned user IDs in user_id order, one keyset page at a time."""
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = page_size if remaining is None else min(page_size, remaining)
+        page = await get_broadcast_user_ids(after_user_id, size)
+        for user_id in page:
+            yield user_id
+        if len(page) < size:
+            return
+        after_user_id = page[-1]
+        if remaining is not None:
+            remaining -= len(page)
+
+@run_in_db_executor
 def get_user_info_by_id(user_id):
     """Fetches a single user's details by ID."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT user_id, username, first_name, last_name, joined_date, is_banned FROM users WHERE user_id = %s', (user_id,))
-    user = cursor.fetchone()
-    conn.close()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT user_id, username, first_name, last_name, joined_date, is_banned FROM users WHERE user_id = %s', (user_id,))
+        user = cursor.fetchone()
     return user
 
+@run_in_db_executor
 def add_force_sub_channel(channel_username, channel_title):
-    conn = get_db_connection()
-    cursor = conn.cursor()
     try:
-        cursor.execute('UPDATE force_sub_channels SET is_active = TRUE, channel_title = %s WHERE channel_username = %s', (channel_title, channel_username))
-        if cursor.rowcount == 0:
-            cursor.execute('''
-                INSERT INTO force_sub_channels (channel_username, channel_title, is_active)
-                VALUES (%s, %s, TRUE)
-            ''', (channel_username, channel_title))
-        conn.commit()
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('UPDATE force_sub_channels SET is_active = TRUE, channel_title = %s WHERE channel_username = %s', (channel_title, channel_username))
+            if cursor.rowcount == 0:
+                cursor.execute('''
+                    INSERT INTO force_sub_channels (channel_username, channel_title, is_active)
+                    VALUES (%s, %s, TRUE)
+                ''', (channel_username, channel_title))
+            notify_workers(cursor, 'channels')
+            conn.commit()
+        force_sub_channel_cache.invalidate()
         return True
     except Exception as e:
         logger.error(f"DB Error adding channel: {e}")
         return False
-    finally:
-        conn.close()
 
-def get_all_force_sub_channels(return_usernames_only=False):
+@run_in_db_executor
+def load_force_sub_channels():
+    """Fetches all active force sub channels as [(username, title), ...]."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT channel_username, channel_title FROM force_sub_channels WHERE is_active = TRUE ORDER BY channel_title')
+        channels = cursor.fetchall()
+    return channels
+
+async def get_all_force_sub_channels(return_usernames_only=False):
     """
-    Fetches all active force sub channels.
+    Fetches all active force sub channels (served from the channel cache).
     If return_usernames_only is True, returns a list of usernames.
     Otherwise, returns a list of tuples: [(username, title), ...]
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    channels = await force_sub_channel_cache.get()
     if return_usernames_only:
-        cursor.execute('SELECT channel_username FROM force_sub_channels WHERE is_active = TRUE ORDER BY channel_title')
-        channels = [row[0] for row in cursor.fetchall()]
-    else:
-        cursor.execute('SELECT channel_username, channel_title FROM force_sub_channels WHERE is_active = TRUE ORDER BY channel_title')
-        channels = cursor.fetchall()
-    conn.close()
-    return channels
+        return [uname for uname, _ in channels]
+    return list(channels)
 
+@run_in_db_executor
 def get_force_sub_channel_info(channel_username):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT channel_username, channel_title FROM force_sub_channels WHERE channel_username = %s AND is_active = TRUE', (channel_username,))
-    channel = cursor.fetchone()
-    conn.close()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT channel_username, channel_title FROM force_sub_channels WHERE channel_username = %s AND is_active = TRUE', (channel_username,))
+        channel = cursor.fetchone()
     return channel
 
+@run_in_db_executor
 def delete_force_sub_channel(channel_username):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('UPDATE force_sub_channels SET is_active = FALSE WHERE channel_username = %s', (channel_username,))
-    conn.commit()
-    conn.close()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('UPDATE force_sub_channels SET is_active = FALSE WHERE channel_username = %s', (channel_username,))
+        notify_workers(cursor, 'channels')
+        conn.commit()
+    force_sub_channel_cache.invalidate()
 
+@run_in_db_executor
 def generate_link_id(channel_username, user_id, never_expires=False):
     """Generate a link that optionally never expires"""
     link_id = secrets.token_urlsafe(16)
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO generated_links (link_id, channel_username, user_id, never_expires)
-        VALUES (%s, %s, %s, %s)
-        ON CONFLICT (link_id) DO UPDATE SET channel_username = EXCLUDED.channel_username
-    ''', (link_id, channel_username, user_id, never_expires))
-    conn.commit()
-    conn.close()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO generated_links (link_id, channel_username, user_id, never_expires)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (link_id) DO UPDATE SET channel_username = EXCLUDED.channel_username
+        ''', (link_id, channel_username, user_id, never_expires))
+        conn.commit()
     return link_id
 
-def get_link_info(link_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT channel_username, user_id, created_time, never_expires
-        FROM generated_links WHERE link_id = %s
-    ''', (link_id,))
-    result = cursor.fetchone()
-    conn.close()
+@run_in_db_executor
+def get_linked_channel_identifiers():
+    """Distinct channels referenced by generated deep links."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT DISTINCT channel_username FROM generated_links WHERE channel_username IS NOT NULL')
+        channels = [row[0] for row in cursor.fetchall()]
+    return channels
+
+@run_in_db_executor
+def fetch_link_info(link_id):
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT channel_username, user_id, created_time, never_expires
+            FROM generated_links WHERE link_id = %s
+        ''', (link_id,))
+        result = cursor.fetchone()
     return result
     
-# ========== FORCE SUBSCRIPTION LOGIC ==========
+BROADCAST_CAMPAIGN_FIELDS = (
+    'chunk_number', 'last_user_id', 'sent_count', 'failed_count', 'blocked_count',
+    'status', 'next_run_at', 'status_message_id'
+)
 
-async def is_user_subscribed(user_id: int, bot) -> bool:
-    """Check if user is member of all force-sub channels."""
-    force_sub_channels = get_all_force_sub_channels(return_usernames_only=True)
-    if not force_sub_channels:
-        return True
+@run_in_db_executor
+def create_broadcast_campaign(admin_chat_id, message_chat_id, message_id, chunk_size=None, total_estimate=0):
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO broadcast_campaigns (admin_chat_id, message_chat_id, message_id, chunk_size, total_estimate)
+            VALUES (%s, %s, %s, %s, %s)
+            RETURNING campaign_id
+        ''', (admin_chat_id, message_chat_id, message_id, chunk_size, total_estimate))
+        campaign_id = cursor.fetchone()[0]
+        conn.commit()
+    return campaign_id
+
+@run_in_db_executor
+def get_broadcast_campaign(campaign_id):
+    """Returns the campaign row as a dict, or None."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cursor.execute('''
+            SELECT campaign_id, admin_chat_id, message_chat_id, message_id, chunk_size,
+                   chunk_number, last_user_id, sent_count, failed_count, blocked_count,
+                   total_estimate, status, status_message_id
+            FROM broadcast_campaigns WHERE campaign_id = %s
+        ''', (campaign_id,))
+        campaign = cursor.fetchone()
+    return dict(campaign) if campaign else None
+
+@run_in_db_executor
+def update_broadcast_campaign(campaign_id, **fields):
+    """Updates the given progress/status columns of a campaign."""
+    columns = [name for name in fields if name in BROADCAST_CAMPAIGN_FIELDS]
+    if len(columns) != len(fields):
+        raise ValueError(f"Unknown broadcast campaign fields: {set(fields) - set(columns)}")
+    assignments = ", ".join(f"{name} = %s" for name in columns)
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            f'UPDATE broadcast_campaigns SET {assignments}, updated_at = CURRENT_TIMESTAMP WHERE campaign_id = %s',
+            (*[fields[name] for name in columns], campaign_id)
+        )
+        conn.commit()
 
-    for ch in force_sub_channels:
-        try:
-            member = await bot.get_chat_member(chat_id=ch, user_id=user_id)
-            if member.status in ['left', 'kicked']:
+@run_in_db_executor
+def get_unfinished_broadcast_campaigns():
+    """Returns [(campaign_id, next_run_at), ...] for campaigns still running."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT campaign_id, next_run_at FROM broadcast_campaigns WHERE status = 'running' ORDER BY campaign_id")
+        campaigns = cursor.fetchall()
+    return campaigns
+
+@run_in_db_executor
+def delete_expired_links(cutoff, limit):
+    """Deletes at most `limit` expired links in one short transaction; returns rows removed."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        # Only delete expired links that are not set to never expire
+        cursor.execute('''
+            DELETE FROM generated_links WHERE link_id IN (
+                SELECT link_id FROM generated_links
+                WHERE created_time < %s AND never_expires = FALSE
+                LIMIT %s
+            )
+        ''', (cutoff, limit))
+        deleted = cursor.rowcount
+        conn.commit()
+    return deleted
+
+@run_in_db_executor
+def fetch_conversation_state(user_id):
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT state, prompt_message_id, data FROM conversation_states
+            WHERE user_id = %s AND expires_at > NOW()
+        ''', (user_id,))
+        result = cursor.fetchone()
+    return result
+
+@run_in_db_executor
+def save_conversation_state(user_id, state, data, ttl):
+    """Sets the flow state and its data in one upsert; the prompt ID is left alone."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO conversation_states (user_id, state, data, expires_at)
+            VALUES (%s, %s, %s, NOW() + make_interval(secs => %s))
+            ON CONFLICT (user_id) DO UPDATE SET
+                state = EXCLUDED.state, data = EXCLUDED.data, expires_at = EXCLUDED.expires_at
+        ''', (user_id, state, psycopg2.extras.Json(data), ttl))
+        conn.commit()
+
+@run_in_db_executor
+def clear_conversation_state(user_id):
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE conversation_states SET state = NULL, data = '{}' WHERE user_id = %s AND state IS NOT NULL",
+            (user_id,)
+        )
+        conn.commit()
+
+@run_in_db_executor
+def save_conversation_prompt(user_id, prompt_message_id, ttl):
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO conversation_states (user_id, prompt_message_id, expires_at)
+            VALUES (%s, %s, NOW() + make_interval(secs => %s))
+            ON CONFLICT (user_id) DO UPDATE SET
+                prompt_message_id = EXCLUDED.prompt_message_id, expires_at = EXCLUDED.expires_at
+        ''', (user_id, prompt_message_id, ttl))
+        conn.commit()
+
+@run_in_db_executor
+def take_conversation_prompt(user_id):
+    """Clears and returns the stored prompt message ID; the row lock makes it one-shot."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            WITH old AS (
+                SELECT user_id, prompt_message_id FROM conversation_states
+                WHERE user_id = %s AND prompt_message_id IS NOT NULL
+                FOR UPDATE
+            )
+            UPDATE conversation_states c SET prompt_message_id = NULL
+            FROM old WHERE c.user_id = old.user_id
+            RETURNING old.prompt_message_id
+        ''', (user_id,))
+        result = cursor.fetchone()
+        conn.commit()
+    return result[0] if result else None
+
+@run_in_db_executor
+def delete_expired_conversation_states():
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM conversation_states WHERE expires_at <= NOW()')
+        deleted = cursor.rowcount
+        conn.commit()
+    return deleted
+
+@run_in_db_executor
+def delete_conversation_state(user_id):
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM conversation_states WHERE user_id = %s', (user_id,))
+        conn.commit()
+
+@run_in_db_executor
+def enqueue_shared_update(update_id, shard, payload):
+    """Queues a raw webhook update for the workers; a resent update_id is ignored."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO update_queue (update_id, shard, payload) VALUES (%s, %s, %s)
+            ON CONFLICT (update_id) DO NOTHING
+        ''', (update_id, shard, psycopg2.extras.Json(payload)))
+        conn.commit()
+
+@run_in_db_executor
+def claim_queued_updates(shard, limit):
+    """Removes and returns up to `limit` of the shard's oldest updates, in update_id order.
+
+    SKIP LOCKED keeps a second consumer of the same shard (e.g. during a
+    failover) from blocking on or double-claiming rows. Claiming deletes the
+    rows, so delivery is at most once.
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            DELETE FROM update_queue WHERE update_id IN (
+                SELECT update_id FROM update_queue
+                WHERE shard = %s
+                ORDER BY update_id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING update_id, payload
+        ''', (shard, limit))
+        rows = cursor.fetchall()
+        conn.commit()
+    return [payload for _, payload in sorted(rows, key=lambda row: row[0])]
+
+@run_in_db_executor
+def ping_database():
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT 1')
+        cursor.fetchone()
+
+@run_in_db_executor
+def fetch_service_state(key):
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT value FROM service_state WHERE key = %s', (key,))
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+@run_in_db_executor
+def save_service_state(key, value):
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO service_state (key, value, updated_at) VALUES (%s, %s, CURRENT_TIMESTAMP)
+            ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = EXCLUDED.updated_at
+        ''', (key, psycopg2.extras.Json(value)))
+        conn.commit()
+
+# ========== CACHES ==========
+
+class ForceSubChannelCache:
+    """TTL cache of the active force-sub channel list.
+
+    One load serves both the usernames-only and (username, title) views.
+    Admin edits call invalidate(); the generation counter stops a load that
+    was already in flight from storing the pre-edit list afterwards.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._channels = None
+        self._loaded_at = 0.0
+        self._generation = 0
+        self._lock = asyncio.Lock()
+
+    def _is_fresh(self):
+        return self._channels is not None and time.monotonic() - self._loaded_at < self.ttl
+
+    async def get(self):
+        if self._is_fresh():
+            self.hits += 1
+            return self._channels
+
+        async with self._lock:
+            if self._is_fresh():
+                self.hits += 1
+                return self._channels
+            self.misses += 1
+            generation = self._generation
+            channels = tuple(await load_force_sub_channels())
+            if generation == self._generation:
+                self._channels = channels
+                self._loaded_at = time.monotonic()
+            return channels
+
+    def invalidate(self):
+        self._generation += 1
+        self._channels = None
+
+force_sub_channel_cache = ForceSubChannelCache(FORCE_SUB_CACHE_TTL)
+
+class MembershipCache:
+    """LRU cache of get_chat_member results keyed by (user_id, channel).
+
+    Members and non-members get separate TTLs so a user who leaves is
+    re-checked eventually, while a user who was told to join is re-checked
+    soon. Failed lookups are never cached.
+    """
+
+    def __init__(self, member_ttl, non_member_ttl, max_entries):
+        self.member_ttl = member_ttl
+        self.non_member_ttl = non_member_ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, user_id, channel):
+        """Returns the cached membership (True/False) or None when unknown or expired."""
+        key = (user_id, channel)
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, user_id, channel, is_member):
+        ttl = self.member_ttl if is_member else self.non_member_ttl
+        key = (user_id, channel)
+        self._entries[key] = (is_member, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+membership_cache = MembershipCache(MEMBERSHIP_CACHE_MEMBER_TTL, MEMBERSHIP_CACHE_NON_MEMBER_TTL, MEMBERSHIP_CACHE_MAX_ENTRIES)
+
+class BanList:
+    """In-memory set of banned user IDs mirroring users.is_banned.
+
+    ban_user/unban_user update it right after their DB write, so the hot path
+    in force_sub_required never queries Postgres. reconcile_ban_list reloads
+    it periodically to pick up edits made outside the bot; the version
+    counter makes a reload that raced with a ban/unban retry next time
+    instead of overwriting the newer in-memory state.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self._banned = set()
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def __contains__(self, user_id):
+        return user_id in self._banned
+
+    def __len__(self):
+        return len(self._banned)
+
+    @property
+    def version(self):
+        return self._version
+
+    def add(self, user_id):
+        with self._lock:
+            self._banned.add(user_id)
+            self._version += 1
+
+    def discard(self, user_id):
+        with self._lock:
+            self._banned.discard(user_id)
+            self._version += 1
+
+    def replace(self, user_ids, expected_version):
+        """Swaps in a freshly loaded set; returns False if it went stale while loading."""
+        with self._lock:
+            if self._version != expected_version:
                 return False
+            self._banned = set(user_ids)
+            self.loaded = True
+            return True
+
+ban_list = BanList()
+
+class LRUCache:
+    """Bounded LRU mapping with an optional TTL and hit/miss counters."""
+
+    def __init__(self, max_entries, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None or (entry[1] is not None and entry[1] <= time.monotonic()):
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def __len__(self):
+        return len(self._entries)
+
+user_counters_cache = LRUCache(1, ttl=USER_COUNTERS_CACHE_TTL)
+
+# link_id -> generated_links row; rows never change once written.
+link_info_cache = LRUCache(LINK_INFO_CACHE_SIZE)
+# channel identifier (@username or id) -> (chat_id, title)
+channel_info_cache = LRUCache(CHANNEL_INFO_CACHE_SIZE, ttl=CHANNEL_INFO_CACHE_TTL)
+
+class InviteLinkPool:
+    """Reuses one live invite link per channel instead of minting one per click.
+
+    A link is handed out while it has more than `min_remaining` seconds left.
+    rotate_invite_links_job pre-warms every linked channel so a fresh link is
+    normally already in memory; if one still drops under `refresh_remaining`
+    a replacement is minted in the background, and only a cold or fully
+    expired channel is minted inline. Superseded links are left to expire on
+    their own, since users were told their remaining time, and channels that
+    fail to mint back off exponentially.
+    """
+
+    def __init__(self, lifetime, min_remaining, refresh_remaining, max_backoff):
+        self.lifetime = lifetime
+        self.min_remaining = min_remaining
+        self.refresh_remaining = refresh_remaining
+        self.max_backoff = max_backoff
+        self.created = 0
+        self.reused = 0
+        self.errors = 0
+        self._links = {}
+        self._locks = {}
+        self._refresh_tasks = {}
+        self._failures = {}
+
+    def _usable(self, chat_id):
+        entry = self._links.get(chat_id)
+        if entry and entry[1] - time.time() > self.min_remaining:
+            return entry
+        return None
+
+    async def get(self, bot, chat_id):
+        """Returns (invite_link, expires_at) for a link with at least `min_remaining` seconds left."""
+        entry = self._usable(chat_id)
+        if entry is None:
+            async with self._locks.setdefault(chat_id, asyncio.Lock()):
+                entry = self._usable(chat_id)
+                if entry is None:
+                    return await self._mint(bot, chat_id)
+
+        self.reused += 1
+        if entry[1] - time.time() < self.refresh_remaining:
+            self._schedule_refresh(bot, chat_id)
+        return entry
+
+    async def _mint(self, bot, chat_id):
+        expires_at = time.time() + self.lifetime
+        invite_link = await bot.create_chat_invite_link(chat_id, expire_date=expires_at)
+        entry = self._links[chat_id] = (invite_link.invite_link, expires_at)
+        self.created += 1
+        return entry
+
+    async def prewarm(self, bot, channel_identifier):
+        """Makes sure the channel has a link that won't need refreshing soon."""
+        failure = self._failures.get(channel_identifier)
+        if failure and failure[1] > time.time():
+            return
+        try:
+            chat_id, _ = await get_channel_info(bot, channel_identifier)
+            async with self._locks.setdefault(chat_id, asyncio.Lock()):
+                entry = self._links.get(chat_id)
+                if entry is None or entry[1] - time.time() < self.refresh_remaining:
+                    await self._mint(bot, chat_id)
+            self._failures.pop(channel_identifier, None)
         except Exception as e:
-            logger.error(f"Error checking membership in {ch} for user {user_id}: {e}")
-            return False 
-    return True
+            self.errors += 1
+            attempts = failure[0] + 1 if failure else 1
+            backoff = min(self.max_backoff, INVITE_LINK_ROTATION_INTERVAL * 2 ** (attempts - 1))
+            self._failures[channel_identifier] = (attempts, time.time() + backoff)
+            logger.warning(f"Invite link rotation failed for {channel_identifier} (attempt {attempts}), retrying in {backoff}s: {e}")
+
+    def _schedule_refresh(self, bot, chat_id):
+        task = self._refresh_tasks.get(chat_id)
+        if task is None or task.done():
+            self._refresh_tasks[chat_id] = asyncio.create_task(self._refresh(bot, chat_id))
+
+    async def _refresh(self, bot, chat_id):
+        try:
+            async with self._locks.setdefault(chat_id, asyncio.Lock()):
+                entry = self._links.get(chat_id)
+                if entry and entry[1] - time.time() >= self.refresh_remaining:
+                    return
+                await self._mint(bot, chat_id)
+        except Exception as e:
+            logger.warning(f"Background invite link rotation failed for {chat_id}: {e}")
 
-def force_sub_required(func):
-    """Decorator for handlers to enforce force-subscribe, but bypass for admin."""
-    @wraps(func)
-    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
-        user = update.effective_user
-        if user is None:
-            return await func(update, context, *args, **kwargs)
-        
-        force_sub_channels_info = get_all_force_sub_channels(return_usernames_only=False)
-        
-        if user.id == ADMIN_ID:
-            return await func(update, context, *args, **kwargs)
-
-        if is_user_banned(user.id):
-            await delete_update_message(update, context)
-            ban_text = "🚫 You have been banned from using this bot. Contact the administrator for details."
-            if update.message:
-                await update.message.reply_text(ban_text)
-            elif update.callback_query:
-                try:
-                    await update.callback_query.edit_message_text(ban_text)
-                except:
-                    await context.bot.send_message(update.effective_chat.id, ban_text)
+invite_link_pool = InviteLinkPool(
+    LINK_EXPIRY_MINUTES * 60,
+    INVITE_LINK_MIN_REMAINING,
+    INVITE_LINK_REFRESH_REMAINING,
+    INVITE_LINK_MAX_BACKOFF,
+)
+
+# ========== WRITE-BEHIND USER UPSERTS ==========
+
+class UserUpsertQueue:
+    """Write-behind buffer for add_user; coalesces repeat upserts and flushes them in batches."""
+
+    def __init__(self, batch_size, recent_profiles_size):
+        self.batch_size = batch_size
+        self.recent_profiles_size = recent_profiles_size
+        self.pending = {}
+        self.recent_profiles = OrderedDict()
+        self.enqueued = 0
+        self.coalesced = 0
+        self.skipped = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self._flush_lock = asyncio.Lock()
+
+    async def add(self, user_id, username, first_name, last_name):
+        clean_username = username.lstrip('@') if username else None
+        profile = (clean_username, first_name, last_name)
+
+        if self.recent_profiles.get(user_id) == profile:
+            self.recent_profiles.move_to_end(user_id)
+            self.skipped += 1
             return
+        if user_id in self.pending:
+            self.coalesced += 1
+        self.pending[user_id] = profile
+        self.enqueued += 1
+
+        if len(self.pending) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self.pending:
+                return 0
+            batch, self.pending = self.pending, {}
+            rows = [(uid, *profile) for uid, profile in sorted(batch.items())]
+            try:
+                await upsert_users(rows)
+            except Exception as e:
+                logger.error(f"Failed to flush {len(rows)} user upserts, will retry: {e}")
+                for uid, profile in batch.items():
+                    self.pending.setdefault(uid, profile)
+                return 0
+
+            for uid, profile in batch.items():
+                self.recent_profiles[uid] = profile
+                self.recent_profiles.move_to_end(uid)
+            while len(self.recent_profiles) > self.recent_profiles_size:
+                self.recent_profiles.popitem(last=False)
+            self.flushes += 1
+            self.rows_written += len(rows)
+            return len(rows)
+
+    def forget(self, user_ids):
+        """Drops users from the recent-profile cache so their next add() is written."""
+        for uid in user_ids:
+            self.recent_profiles.pop(uid, None)
+
+user_upsert_queue = UserUpsertQueue(USER_UPSERT_BATCH_SIZE, USER_UPSERT_RECENT_PROFILES)
+
+async def add_user(user_id, username, first_name, last_name):
+    """Queues a user upsert; it reaches the DB on the next batch flush."""
+    await user_upsert_queue.add(user_id, username, first_name, last_name)
+
+async def flush_user_upserts_job(context: ContextTypes.DEFAULT_TYPE):
+    await user_upsert_queue.flush()
+
+# ========== CONVERSATION STATE ==========
+
+ConversationState = namedtuple('ConversationState', ['state', 'prompt_message_id', 'data'])
+
+class MemoryConversationStore:
+    """Per-user admin flow state kept in process memory.
+
+    Every write refreshes the TTL; records past it read as missing, so an
+    abandoned flow doesn't capture the admin's next message hours later.
+    Lost on restart and not shared between processes.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._records = {}
+
+    def _live(self, user_id):
+        record = self._records.get(user_id)
+        if record and record['expires_at'] <= time.monotonic():
+            del self._records[user_id]
+            return None
+        return record
+
+    def _touch(self, user_id):
+        record = self._live(user_id) or {'state': None, 'prompt_message_id': None, 'data': {}}
+        record['expires_at'] = time.monotonic() + self.ttl
+        self._records[user_id] = record
+        return record
+
+    async def get(self, user_id):
+        record = self._live(user_id)
+        if not record:
+            return None
+        return ConversationState(record['state'], record['prompt_message_id'], dict(record['data']))
+
+    async def get_state(self, user_id):
+        record = self._live(user_id)
+        return record['state'] if record else None
+
+    async def set_state(self, user_id, state, data=None):
+        record = self._touch(user_id)
+        record['state'] = state
+        record['data'] = dict(data or {})
+
+    async def clear_state(self, user_id):
+        record = self._live(user_id)
+        if record:
+            record['state'] = None
+            record['data'] = {}
+
+    async def set_prompt(self, user_id, prompt_message_id):
+        self._touch(user_id)['prompt_message_id'] = prompt_message_id
+
+    async def pop_prompt(self, user_id):
+        record = self._records.get(user_id)
+        if not record:
+            return None
+        prompt_message_id, record['prompt_message_id'] = record['prompt_message_id'], None
+        return prompt_message_id
+
+    async def reset(self, user_id):
+        self._records.pop(user_id, None)
+
+    async def purge_expired(self):
+        now = time.monotonic()
+        expired = [uid for uid, record in self._records.items() if record['expires_at'] <= now]
+        for uid in expired:
+            del self._records[uid]
+        return len(expired)
+
+class PostgresConversationStore:
+    """Admin flow state in the conversation_states table.
+
+    Survives /reload and redeploys and is shared by every worker. Each call is
+    a single statement, so reads and writes are atomic without extra locking.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+
+    async def get(self, user_id):
+        row = await fetch_conversation_state(user_id)
+        if not row:
+            return None
+        state, prompt_message_id, data = row
+        return ConversationState(state, prompt_message_id, data or {})
+
+    async def get_state(self, user_id):
+        record = await self.get(user_id)
+        return record.state if record else None
+
+    async def set_state(self, user_id, state, data=None):
+        await save_conversation_state(user_id, state, data or {}, self.ttl)
+
+    async def clear_state(self, user_id):
+        await clear_conversation_state(user_id)
+
+    async def set_prompt(self, user_id, prompt_message_id):
+        await save_conversation_prompt(user_id, prompt_message_id, self.ttl)
+
+    async def pop_prompt(self, user_id):
+        return await take_conversation_prompt(user_id)
+
+    async def reset(self, user_id):
+        await delete_conversation_state(user_id)
+
+    async def purge_expired(self):
+        return await delete_expired_conversation_states()
+
+CONVERSATION_STORES = {
+    'memory': MemoryConversationStore,
+    'postgres': PostgresConversationStore,
+}
+
+if CONVERSATION_STORE_BACKEND not in CONVERSATION_STORES:
+    raise ValueError(f"Unknown CONVERSATION_STORE {CONVERSATION_STORE_BACKEND!r}; use one of {sorted(CONVERSATION_STORES)}")
+conversation_store = CONVERSATION_STORES[CONVERSATION_STORE_BACKEND](CONVERSATION_STATE_TTL)
+
+# ========== FORCE SUBSCRIPTION LOGIC ==========
+
+_membership_check_semaphores = {}
+
+async def check_channel_membership(user_id: int, channel, bot, force_refresh=False) -> bool:
+    """Check a single force-sub channel. Errors and timeouts count as not joined."""
+    if not force_refresh:
+        cached = membership_cache.get(user_id, channel)
+        if cached is not None:
+            return cached
+
+    semaphore = _membership_check_semaphores.get(channel)
+    if semaphore is None:
+        semaphore = _membership_check_semaphores[channel] = asyncio.Semaphore(MEMBERSHIP_CHECK_CONCURRENCY)
+
+    try:
+        async with semaphore:
+            member = await asyncio.wait_for(
+                bot.get_chat_member(chat_id=channel, user_id=user_id),
+                timeout=MEMBERSHIP_CHECK_TIMEOUT
+            )
+    except asyncio.TimeoutError:
+        logger.warning(f"Timed out checking membership in {channel} for user {user_id}")
+        return False
+    except Exception as e:
+        logger.error(f"Error checking membership in {channel} for user {user_id}: {e}")
+        return False
+
+    is_member = member.status not in ['left', 'kicked']
+    membership_cache.set(user_id, channel, is_member)
+    return is_member
+
+async def get_missing_force_sub_channels(user_id: int, bot, force_refresh=False):
+    """Returns the usernames of force-sub channels the user has not joined.
+
+    Channels without a cached answer are checked concurrently. Results come from membership_cache unless force_refresh is set, which the
+    verify_subscription button uses so users who just joined aren't rejected.
+    """
+    force_sub_channels = await get_all_force_sub_channels(return_usernames_only=True)
+    missing = set()
+    to_check = []
+    for ch in force_sub_channels:
+        cached = None if force_refresh else membership_cache.get(user_id, ch)
+        if cached is None:
+            to_check.append(ch)
+        elif not cached:
+            missing.add(ch)
+
+    if to_check:
+        results = await asyncio.gather(*(
+            check_channel_membership(user_id, ch, bot, force_refresh=True) for ch in to_check
+        ))
+        missing.update(ch for ch, joined in zip(to_check, results) if not joined)
+
+    return [ch for ch in force_sub_channels if ch in missing]
+
+async def check_force_sub(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Ban and force-subscribe gate. Returns False after replying to a blocked user.
+
+    The admin is let through before the channel list is even fetched.
+    """
+    user = update.effective_user
+    if user is None or user.id == ADMIN_ID:
+        return True
+
+    force_sub_channels_info = await get_all_force_sub_channels(return_usernames_only=False)
+
+    if await is_user_banned(user.id):
+        await delete_update_message(update, context)
+        ban_text = "🚫 You have been banned from using this bot. Contact the administrator for details."
+        if update.message:
+            await update.message.reply_text(ban_text)
+        elif update.callback_query:
+            try:
+                await update.callback_query.edit_message_text(ban_text)
+            except:
+                await context.bot.send_message(update.effective_chat.id, ban_text)
+        return False
 
-        if not force_sub_channels_info:
-            return await func(update, context, *args, **kwargs)
+    if not force_sub_channels_info:
+        return True
 
-        subscribed = await is_user_subscribed(user.id, context.bot)
+    force_refresh = bool(update.callback_query and update.callback_query.data == "verify_subscription")
+    missing_channels = await get_missing_force_sub_channels(user.id, context.bot, force_refresh=force_refresh)
+    
+    if missing_channels:
+        await delete_update_message(update, context)
         
-        if not subscribed:
-            await delete_update_message(update, context)
-            
-            keyboard = []
-            channels_text_list = []
+        keyboard = []
+        channels_text_list = []
+        
+        for uname, title in force_sub_channels_info:
+            if uname not in missing_channels:
+                continue
+            keyboard.append([InlineKeyboardButton(f"{title}", url=f"https://t.me/{uname.lstrip('@')}")])
+            channels_text_list.append(f"• {title} (<code>{uname}</code>)")
             
-            for uname, title in force_sub_channels_info:
-                keyboard.append([InlineKeyboardButton(f"{title}", url=f"https://t.me/{uname.lstrip('@')}")])
-                channels_text_list.append(f"• {title} (<code>{uname}</code>)")
-                
-            keyboard.append([InlineKeyboardButton("Click to continue", callback_data="verify_subscription")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-
-            channels_text = "\n".join(channels_text_list)
-            text = (
-                "<b>Please join our world of anime:</b>\n\n"
-                "After joining, click <b>Verify Subscription</b>."
-            )
+        keyboard.append([InlineKeyboardButton("Click to continue", callback_data="verify_subscription")])
+        reply_markup = InlineKeyboardMarkup(keyboard)
 
-            if update.message:
-                await update.message.reply_text(text, parse_mode='HTML', reply_markup=reply_markup)
-            elif update.callback_query:
-                await update.callback_query.edit_message_text(text, parse_mode='HTML', reply_markup=reply_markup)
+        channels_text = "\n".join(channels_text_list)
+        text = (
+            "<b>Please join our world of anime:</b>\n\n"
+            "After joining, click <b>Verify Subscription</b>."
+        )
+
+        if update.message:
+            await update.message.reply_text(text, parse_mode='HTML', reply_markup=reply_markup)
+        elif update.callback_query:
+            await update.callback_query.edit_message_text(text, parse_mode='HTML', reply_markup=reply_markup)
+        return False
+
+    return True
+
+def force_sub_required(func):
+    """Decorator for handlers to enforce force-subscribe, but bypass for admin."""
+    @wraps(func)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
+        if not await check_force_sub(update, context):
             return
-        
         return await func(update, context, *args, **kwargs)
-
     return wrapper
 
 # ========== ADMIN COMMAND HANDLERS ==========
@@ -359,7 +2317,7 @@ async def reload_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     await delete_update_message(update, context)
-    user_states.pop(update.effective_user.id, None)
+    await conversation_store.clear_state(update.effective_user.id)
     await delete_bot_prompt(context, update.effective_chat.id)
     
     message_id_to_copy = None
@@ -388,6 +2346,7 @@ async def reload_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Failed to write restart file: {e}")
 
     await update.message.reply_text("🔄 **Bot is restarting...** Please wait.", parse_mode='Markdown')
+    await user_upsert_queue.flush()
     
     logger.info("Bot restart initiated by admin. Stopping application.")
     sys.exit(0)
@@ -399,7 +2358,7 @@ async def ban_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await delete_update_message(update, context)
     
-    user_states.pop(update.effective_user.id, None)
+    await conversation_store.clear_state(update.effective_user.id)
     await delete_bot_prompt(context, update.effective_chat.id)
 
     args = context.args
@@ -411,7 +2370,7 @@ async def ban_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     target_arg = args[0]
-    target_user_id = resolve_target_user_id(target_arg)
+    target_user_id = await resolve_target_user_id(target_arg)
 
     if target_user_id is None:
         await update.message.reply_text(f"❌ User **{target_arg}** not found in database.", parse_mode='Markdown')
@@ -421,7 +2380,7 @@ async def ban_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⚠️ Cannot ban the **Admin**.", parse_mode='Markdown')
         return
 
-    ban_user(target_user_id)
+    await ban_user(target_user_id)
     await update.message.reply_text(
         f"🚫 User with ID **{target_user_id}** (Target: {target_arg}) has been **banned**.",
         parse_mode='Markdown'
@@ -434,7 +2393,7 @@ async def unban_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     await delete_update_message(update, context)
 
-    user_states.pop(update.effective_user.id, None)
+    await conversation_store.clear_state(update.effective_user.id)
     await delete_bot_prompt(context, update.effective_chat.id)
 
     args = context.args
@@ -446,13 +2405,13 @@ async def unban_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
 
     target_arg = args[0]
-    target_user_id = resolve_target_user_id(target_arg)
+    target_user_id = await resolve_target_user_id(target_arg)
 
     if target_user_id is None:
         await update.message.reply_text(f"❌ User **{target_arg}** not found in database.", parse_mode='Markdown')
         return
         
-    unban_user(target_user_id)
+    await unban_user(target_user_id)
     await update.message.reply_text(
         f"✅ User with ID **{target_user_id}** (Target: {target_arg}) has been **unbanned**.",
         parse_mode='Markdown'
@@ -491,7 +2450,7 @@ async def add_channel_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         )
         return
 
-    if add_force_sub_channel(channel_username, channel_title):
+    if await add_force_sub_channel(channel_username, channel_title):
         await update.message.reply_text(
             f"✅ Successfully added/updated channel:\n**Title:** {channel_title}\n**Username:** `{channel_username}`",
             parse_mode='Markdown'
@@ -521,7 +2480,7 @@ async def remove_channel_command(update: Update, context: ContextTypes.DEFAULT_T
         await update.message.reply_text("❌ Channel username must start with **@**.", parse_mode='Markdown')
         return
 
-    channel_info = get_force_sub_channel_info(channel_username)
+    channel_info = await get_force_sub_channel_info(channel_username)
     if not channel_info:
         await update.message.reply_text(
             f"⚠️ Channel **{channel_username}** is not active or does not exist in the list.",
@@ -529,12 +2488,42 @@ async def remove_channel_command(update: Update, context: ContextTypes.DEFAULT_T
         )
         return
 
-    delete_force_sub_channel(channel_username)
+    await delete_force_sub_channel(channel_username)
     await update.message.reply_text(
         f"🗑️ Successfully removed/deactivated channel **{channel_username}**.",
         parse_mode='Markdown'
     )
 
+async def build_stats_text():
+    """Builds the HTML body shared by /stats and the admin stats panel."""
+    counters = await get_user_counters()
+    channel_count = len(await get_all_force_sub_channels()) 
+    pool = db_pool.stats()
+    return (
+        "📊 <b>BOT STATISTICS</b>\n\n"
+        f"👤 Total Users: {counters.get('total', 0)}\n"
+        f"✅ Active: {counters.get('active', 0)} | 🚫 Banned: {counters.get('banned', 0)} | "
+        f"📵 Unreachable: {counters.get('unreachable', 0)}\n"
+        f"📢 Force Sub Channels: {channel_count}\n"
+        f"🔗 Link Expiry: {LINK_EXPIRY_MINUTES} minutes\n\n"
+        "🗄️ <b>DB Pool</b>\n"
+        f"In use: {pool['in_use']}/{pool['max_size']} | Waiting: {pool['waiting']}\n"
+        f"Checkout: avg {pool['avg_checkout_ms']:.1f} ms, max {pool['max_checkout_ms']:.1f} ms\n"
+        f"Reconnects: {pool['reconnects']} | Timeouts: {pool['timeouts']}\n\n"
+        "⚡ <b>Caches</b>\n"
+        f"Channel list: {force_sub_channel_cache.hits} hits / {force_sub_channel_cache.misses} misses\n"
+        f"Membership: {membership_cache.hits} hits / {membership_cache.misses} misses ({len(membership_cache)} entries)\n"
+        f"User upserts: {user_upsert_queue.rows_written} written, {user_upsert_queue.skipped} skipped, "
+        f"{user_upsert_queue.coalesced} coalesced, {len(user_upsert_queue.pending)} pending\n"
+        f"Deep links: {link_info_cache.hits} hits / {link_info_cache.misses} misses | "
+        f"Channels: {channel_info_cache.hits} hits / {channel_info_cache.misses} misses\n"
+        f"Invite links: {invite_link_pool.created} created, {invite_link_pool.reused} reused, "
+        f"{invite_link_pool.errors} errors\n\n"
+        "🧹 <b>Link Cleanup</b>\n"
+        f"Last run: {cleanup_stats['last_deleted']} rows in {cleanup_stats['last_duration']:.2f}s"
+        f"{' (backlog)' if cleanup_stats['backlog'] else ''} | Total: {cleanup_stats['total_deleted']}"
+    )
+
 @force_sub_required
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Admin command to show bot statistics."""
@@ -543,18 +2532,10 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
     await delete_update_message(update, context)
     
-    user_states.pop(update.effective_user.id, None)
+    await conversation_store.clear_state(update.effective_user.id)
     await delete_bot_prompt(context, update.effective_chat.id)
 
-    user_count = get_user_count()
-    channel_count = len(get_all_force_sub_channels()) 
-    
-    stats_text = (
-        "📊 <b>BOT STATISTICS</b>\n\n"
-        f"👤 Total Users: {user_count}\n"
-        f"📢 Force Sub Channels: {channel_count}\n"
-        f"🔗 Link Expiry: {LINK_EXPIRY_MINUTES} minutes"
-    )
+    stats_text = await build_stats_text()
     
     keyboard = [
         [InlineKeyboardButton("🔙 BACK TO MENU", callback_data="admin_back")]
@@ -581,7 +2562,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception as e:
             logger.warning(f"Could not delete subscription prompt message: {e}")
     
-    add_user(user.id, user.username, user.first_name, user.last_name)
+    await add_user(user.id, user.username, user.first_name, user.last_name)
 
     if context.args and len(context.args) > 0:
         link_id = context.args[0]
@@ -590,7 +2571,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if user.id == ADMIN_ID:
         await delete_bot_prompt(context, update.effective_chat.id)
-        user_states.pop(user.id, None)
+        await conversation_store.clear_state(user.id)
         await send_admin_menu(update.effective_chat.id, context)
     else:
         keyboard = [
@@ -621,16 +2602,26 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
-    if user_id != ADMIN_ID or user_id not in user_states:
+    if user_id != ADMIN_ID:
         return
 
-    state = user_states[user_id]
+    conversation = await conversation_store.get(user_id)
+    if not conversation or conversation.state is None:
+        return
+
+    with metrics.timer('admin_flow_latency_seconds', 'admin_flow_errors_total',
+                       state=ADMIN_STATE_METRIC_NAMES.get(conversation.state, 'unknown')):
+        await process_admin_input(update, context, conversation)
+
+async def process_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE, conversation):
+    user_id = update.effective_user.id
+    state = conversation.state
     text = update.message.text
 
     await delete_bot_prompt(context, update.effective_chat.id)
 
     if state == PENDING_BROADCAST:
-        user_states.pop(user_id, None)
+        await conversation_store.clear_state(user_id)
         await broadcast_message_to_all_users(update, context, update.message) 
         await send_admin_menu(update.effective_chat.id, context)
         return
@@ -638,33 +2629,32 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
     if text is None:
         await delete_update_message(update, context)
         msg = await update.message.reply_text("❌ Please send a text message.", parse_mode='HTML')
-        context.user_data['bot_prompt_message_id'] = msg.message_id
+        await conversation_store.set_prompt(user_id, msg.message_id)
         return
 
     if state == ADD_CHANNEL_USERNAME:
         await delete_update_message(update, context)
         if not text.startswith('@'):
             msg = await update.message.reply_text("❌ Please include @ in channel username.", parse_mode='HTML')
-            context.user_data['bot_prompt_message_id'] = msg.message_id
+            await conversation_store.set_prompt(user_id, msg.message_id)
             return
             
-        context.user_data['channel_username'] = text
-        user_states[user_id] = ADD_CHANNEL_TITLE
+        await conversation_store.set_state(user_id, ADD_CHANNEL_TITLE, {'channel_username': text})
         
         msg = await update.message.reply_text(
             "📝 Send channel title now.",
             parse_mode='HTML',
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 CANCEL", callback_data="manage_force_sub")]])
         )
-        context.user_data['bot_prompt_message_id'] = msg.message_id
+        await conversation_store.set_prompt(user_id, msg.message_id)
         
     elif state == ADD_CHANNEL_TITLE:
         await delete_update_message(update, context)
-        channel_username = context.user_data.pop('channel_username', None)
+        channel_username = conversation.data.get('channel_username')
         channel_title = text
-        user_states.pop(user_id, None)
+        await conversation_store.clear_state(user_id)
 
-        if add_force_sub_channel(channel_username, channel_title):
+        if await add_force_sub_channel(channel_username, channel_title):
             await update.message.reply_text(
                 f"✅ Channel added: {channel_title} ({channel_username})",
                 parse_mode='HTML',
@@ -680,10 +2670,10 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
             msg = await update.message.reply_text(
                 "❌ Invalid format. Use @username or channel ID (-100...)", parse_mode='HTML'
             )
-            context.user_data['bot_prompt_message_id'] = msg.message_id
+            await conversation_store.set_prompt(user_id, msg.message_id)
             return
             
-        user_states.pop(user_id, None)
+        await conversation_store.clear_state(user_id)
         
         try:
             chat = await context.bot.get_chat(channel_identifier)
@@ -697,7 +2687,7 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
             return
             
         # Generate link that persists after redeploy
-        link_id = generate_link_id(str(channel_identifier), user_id, never_expires=True)
+        link_id = await generate_link_id(str(channel_identifier), user_id, never_expires=True)
         botname = context.bot.username
         deep_link = f"https://t.me/{botname}?start={link_id}"
         await update.message.reply_text(
@@ -706,260 +2696,350 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 BACK TO MENU", callback_data="admin_back")]])
         )
 
-@force_sub_required
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    user_id = query.from_user.id
-    data = query.data
+# ========== CALLBACK ROUTER ==========
 
-    if data == "verify_subscription":
-        return await start(update, context)
+BanToggle = namedtuple('BanToggle', ['user_id', 'ban'])
+BroadcastAction = namedtuple('BroadcastAction', ['action', 'campaign_id'])
 
-    if user_id == ADMIN_ID and user_id in user_states:
-        current = user_states[user_id]
-        if current in [PENDING_BROADCAST, GENERATE_LINK_CHANNEL_USERNAME, ADD_CHANNEL_TITLE, ADD_CHANNEL_USERNAME] and data in ["admin_back", "manage_force_sub", "user_management"]:
-            await delete_bot_prompt(context, query.message.chat_id)
-            user_states.pop(user_id, None)
+def parse_ban_toggle(payload):
+    """`f<user_id>_f<1|0>` -> BanToggle."""
+    user_part, status_part = payload.split('_')
+    return BanToggle(int(user_part.lstrip('f')), int(status_part.lstrip('f')) == 1)
 
-    if data == "close_message":
-        try:
-            await query.delete_message()
-        except Exception as e:
-            logger.warning(f"Could not delete message: {e}")
-        return
+def parse_broadcast_action(payload):
+    """`<pause|resume|cancel>_<campaign_id>` -> BroadcastAction."""
+    action, campaign_id = payload.split('_', 1)
+    return BroadcastAction(action, int(campaign_id))
 
-    elif data.startswith("manage_user_"):
-        if user_id != ADMIN_ID:
-            await query.answer("You are not authorized", show_alert=True)
-            return
-            
-        user_states.pop(user_id, None)
-        await delete_bot_prompt(context, query.message.chat_id)
-        
-        try:
-            target_user_id = int(data[12:]) 
-            await send_single_user_management(query, context, target_user_id)
-        except ValueError:
-            await query.answer("Invalid User ID.", show_alert=True)
-        return
-        
-    elif data.startswith("toggle_ban_"):
-        if user_id != ADMIN_ID:
-            await query.answer("You are not authorized", show_alert=True)
-            return
+def parse_channel_username(payload):
+    if not payload:
+        raise ValueError("empty channel username")
+    return payload
 
-        try:
-            parts = data.split('_')
-            target_user_id = int(parts[2].lstrip('f'))
-            target_status = int(parts[3].lstrip('f'))
+class CallbackRoute:
+    """A callback handler plus the policies the router applies before calling it.
 
-            if target_user_id == ADMIN_ID:
-                await query.answer("Cannot ban self!", show_alert=True)
-                await send_single_user_management(query, context, target_user_id) 
-                return
+    admin_only  -- rejected for everyone but ADMIN_ID before any other work
+    force_sub   -- runs the ban / force-subscribe check (skipped for the admin)
+    answer      -- answer the query up front; False when the handler answers
+                   itself (e.g. with an alert)
+    """
 
-            if target_status == 1:
-                ban_user(target_user_id)
-                action = "banned"
-            else:
-                unban_user(target_user_id)
-                action = "unbanned"
-            
-            await send_single_user_management(query, context, target_user_id) 
-            await query.answer(f"User {target_user_id} successfully {action}.", show_alert=True)
+    def __init__(self, name, handler, parse=None, admin_only=False, force_sub=False, answer=True):
+        self.name = name
+        self.handler = handler
+        self.parse = parse
+        self.admin_only = admin_only
+        self.force_sub = force_sub
+        self.answer = answer
 
-        except Exception as e:
-            logger.error(f"Error handling ban/unban: {e}")
-            await query.answer("Error processing request.", show_alert=True)
+class CallbackRouter:
+    """Dispatches callback data by exact match, then by longest registered prefix.
 
-    elif data == "admin_broadcast_start":
-        if user_id != ADMIN_ID:
-            await query.edit_message_text("❌ Admin only", parse_mode='HTML')
-            return
-        user_states[user_id] = PENDING_BROADCAST
-        
-        try: await query.delete_message()
-        except: pass
+    Exact routes are a dict lookup; prefix routes live in a character trie, so
+    resolving costs O(len(data)) however many routes are registered.
+    """
 
-        msg = await context.bot.send_message(
-            chat_id=query.message.chat_id,
-            text="📣 Send the message (text, photo, video, etc.) to broadcast now.",
-            parse_mode='HTML',
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 CANCEL", callback_data="admin_back")]])
-        )
-        context.user_data['bot_prompt_message_id'] = msg.message_id
-        return
+    def __init__(self):
+        self.exact = {}
+        self.trie = {}
+        self.unrouted = 0
 
-    elif data == "admin_stats":
-        if user_id != ADMIN_ID:
-            await query.edit_message_text("❌ Admin only", parse_mode='HTML')
+    def add(self, key, handler, prefix=False, **policies):
+        route = CallbackRoute(key, handler, **policies)
+        if not prefix:
+            self.exact[key] = route
             return
-        await send_admin_stats(query, context)
-
-    elif data == "user_management":
-        if user_id != ADMIN_ID:
-            await query.edit_message_text("❌ Admin only", parse_mode='HTML')
+        node = self.trie
+        for char in key:
+            node = node.setdefault(char, {})
+        node[None] = route
+
+    def resolve(self, data):
+        """Returns (route, raw payload), or (None, None) if nothing matches."""
+        route = self.exact.get(data)
+        if route:
+            return route, None
+        match = (None, None)
+        node = self.trie
+        for i, char in enumerate(data):
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                match = (node[None], data[i + 1:])
+        return match
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        data = query.data or ''
+        route, raw_payload = self.resolve(data)
+
+        if route is None:
+            self.unrouted += 1
+            metrics.inc('callback_unrouted_total')
+            logger.warning(f"Unrouted callback {data!r} from user {query.from_user.id}")
+            await query.answer("This button is no longer available.", show_alert=True)
             return
-            
-        user_states.pop(user_id, None)
-        await delete_bot_prompt(context, query.message.chat_id)
-        
-        await send_user_management(query, context, offset=0)
 
-    elif data.startswith("user_page_"):
-        if user_id != ADMIN_ID:
-            await query.edit_message_text("❌ Admin only", parse_mode='HTML')
+        if route.admin_only and query.from_user.id != ADMIN_ID:
+            await query.answer("❌ Admin only", show_alert=True)
             return
-        try:
-            offset = int(data[10:])
-        except:
-            offset = 0
-        await send_user_management(query, context, offset=offset)
 
-    elif data == "manage_force_sub":
-        if user_id != ADMIN_ID:
-            await query.edit_message_text("❌ Admin only", parse_mode='HTML')
-            return
-        await show_force_sub_management(query, context)
+        payload = None
+        if route.parse:
+            try:
+                payload = route.parse(raw_payload)
+            except ValueError:
+                logger.warning(f"Malformed callback {data!r} for route {route.name}")
+                await query.answer("Invalid request.", show_alert=True)
+                return
 
-    elif data == "generate_links":
-        if user_id != ADMIN_ID:
-            await query.edit_message_text("❌ Admin only", parse_mode='HTML')
+        if route.answer:
+            await query.answer()
+
+        if route.force_sub and not await check_force_sub(update, context):
             return
-        user_states[user_id] = GENERATE_LINK_CHANNEL_USERNAME
-        
-        try: await query.delete_message()
-        except: pass
-        
-        msg = await context.bot.send_message(
-            chat_id=query.message.chat_id,
-            text="🔗 Send channel username or ID to generate deep link.",
-            parse_mode='HTML',
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 CANCEL", callback_data="admin_back")]])
-        )
-        context.user_data['bot_prompt_message_id'] = msg.message_id
-        
-    elif data == "add_channel_start":
-        if user_id != ADMIN_ID:
-            await query.edit_message_text("❌ Admin only", parse_mode='HTML')
+
+        await route.handler(update, context, payload)
+
+async def clear_admin_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Drops any pending admin input state and its prompt message."""
+    await conversation_store.clear_state(update.effective_user.id)
+    await delete_bot_prompt(context, update.effective_chat.id)
+
+async def prompt_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE, state, text, cancel_callback):
+    """Replaces the menu with an input prompt and waits for the admin's next message in `state`."""
+    query = update.callback_query
+    await conversation_store.set_state(query.from_user.id, state)
+
+    try: await query.delete_message()
+    except: pass
+
+    msg = await context.bot.send_message(
+        chat_id=query.message.chat_id,
+        text=text,
+        parse_mode='HTML',
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 CANCEL", callback_data=cancel_callback)]])
+    )
+    await conversation_store.set_prompt(query.message.chat_id, msg.message_id)
+
+async def callback_verify_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    # start() runs its own force-sub check, with a forced membership refresh.
+    await start(update, context)
+
+async def callback_close_message(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    try:
+        await update.callback_query.delete_message()
+    except Exception as e:
+        logger.warning(f"Could not delete message: {e}")
+
+async def callback_manage_user(update: Update, context: ContextTypes.DEFAULT_TYPE, target_user_id):
+    await clear_admin_prompt(update, context)
+    await send_single_user_management(update.callback_query, context, target_user_id)
+
+async def callback_toggle_ban(update: Update, context: ContextTypes.DEFAULT_TYPE, toggle):
+    query = update.callback_query
+    try:
+        if toggle.user_id == ADMIN_ID:
+            await query.answer("Cannot ban self!", show_alert=True)
+            await send_single_user_management(query, context, toggle.user_id)
             return
-        user_states[user_id] = ADD_CHANNEL_USERNAME
-        
-        try: await query.delete_message()
-        except: pass
-        
-        msg = await context.bot.send_message(
-            chat_id=query.message.chat_id,
-            text="📢 Send @username of channel to add to force-sub list.",
-            parse_mode='HTML',
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 CANCEL", callback_data="manage_force_sub")]])
-        )
-        context.user_data['bot_prompt_message_id'] = msg.message_id
 
-    elif data.startswith("channel_"):
-        if user_id != ADMIN_ID:
-            await query.edit_message_text("❌ Admin only", parse_mode='HTML')
-            return
-        await show_channel_details(query, context, data[8:])
+        if toggle.ban:
+            await ban_user(toggle.user_id)
+            action = "banned"
+        else:
+            await unban_user(toggle.user_id)
+            action = "unbanned"
+
+        await send_single_user_management(query, context, toggle.user_id)
+        await query.answer(f"User {toggle.user_id} successfully {action}.", show_alert=True)
+
+    except Exception as e:
+        logger.error(f"Error handling ban/unban: {e}")
+        await query.answer("Error processing request.", show_alert=True)
+
+async def callback_broadcast_start(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    await prompt_admin_input(
+        update, context, PENDING_BROADCAST,
+        "📣 Send the message (text, photo, video, etc.) to broadcast now.", "admin_back"
+    )
+
+async def callback_broadcast_control(update: Update, context: ContextTypes.DEFAULT_TYPE, broadcast_action):
+    await handle_broadcast_control(update.callback_query, context, broadcast_action)
+
+async def callback_admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    await send_admin_stats(update.callback_query, context)
+
+async def callback_user_management(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    await clear_admin_prompt(update, context)
+    await send_user_management(update.callback_query, context, offset=0)
+
+async def callback_user_page(update: Update, context: ContextTypes.DEFAULT_TYPE, offset):
+    await send_user_management(update.callback_query, context, offset=offset)
 
-    elif data.startswith("delete_"):
-        if user_id != ADMIN_ID:
-            await query.edit_message_text("❌ Admin only", parse_mode='HTML')
-            return
-        channel_username_clean = data[7:]
-        channel_username = '@' + channel_username_clean
-        channel_info = get_force_sub_channel_info(channel_username)
-        if channel_info:
-            keyboard = [
-                [InlineKeyboardButton("✅ YES, DELETE", callback_data=f"confirm_delete_{channel_username_clean}")],
-                [InlineKeyboardButton("❌ NO, CANCEL", callback_data=f"channel_{channel_username_clean}")]
-            ]
-            await query.edit_message_text(
-                f"🗑️ Confirm deletion of {channel_info[1]} ({channel_info[0]})?",
-                parse_mode='HTML',
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
+async def callback_manage_force_sub(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    await clear_admin_prompt(update, context)
+    await show_force_sub_management(update.callback_query, context)
 
-    elif data.startswith("confirm_delete_"):
-        if user_id != ADMIN_ID:
-            await query.edit_message_text("❌ Admin only", parse_mode='HTML')
-            return
-        channel_username_clean = data[15:]
-        channel_username = '@' + channel_username_clean
-        delete_force_sub_channel(channel_username)
-        await query.edit_message_text(
-            f"✅ Channel {channel_username} removed from force-sub list.",
+async def callback_generate_links(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    await prompt_admin_input(
+        update, context, GENERATE_LINK_CHANNEL_USERNAME,
+        "🔗 Send channel username or ID to generate deep link.", "admin_back"
+    )
+
+async def callback_add_channel_start(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    await prompt_admin_input(
+        update, context, ADD_CHANNEL_USERNAME,
+        "📢 Send @username of channel to add to force-sub list.", "manage_force_sub"
+    )
+
+async def callback_channel_details(update: Update, context: ContextTypes.DEFAULT_TYPE, channel_username_clean):
+    await show_channel_details(update.callback_query, context, channel_username_clean)
+
+async def callback_delete_channel(update: Update, context: ContextTypes.DEFAULT_TYPE, channel_username_clean):
+    channel_username = '@' + channel_username_clean
+    channel_info = await get_force_sub_channel_info(channel_username)
+    if channel_info:
+        keyboard = [
+            [InlineKeyboardButton("✅ YES, DELETE", callback_data=f"confirm_delete_{channel_username_clean}")],
+            [InlineKeyboardButton("❌ NO, CANCEL", callback_data=f"channel_{channel_username_clean}")]
+        ]
+        await update.callback_query.edit_message_text(
+            f"🗑️ Confirm deletion of {channel_info[1]} ({channel_info[0]})?",
             parse_mode='HTML',
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("📢 Manage Channels", callback_data="manage_force_sub")]])
+            reply_markup=InlineKeyboardMarkup(keyboard)
         )
-        
-    elif data == "delete_channel_prompt":
-        if user_id != ADMIN_ID:
-            await query.edit_message_text("❌ Admin only", parse_mode='HTML')
-            return
-        channels = get_all_force_sub_channels()
-        if not channels:
-            await query.answer("No channels to delete!", show_alert=True)
-            return
 
-        text = "🗑️ Choose a channel to delete (set inactive):"
-        keyboard = []
-        for uname, title in channels:
-            keyboard.append([InlineKeyboardButton(title, callback_data=f"delete_{uname.lstrip('@')}")])
-        
-        keyboard.append([InlineKeyboardButton("🔙 BACK", callback_data="manage_force_sub")])
-        await query.edit_message_text(text=text, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard))
+async def callback_confirm_delete_channel(update: Update, context: ContextTypes.DEFAULT_TYPE, channel_username_clean):
+    channel_username = '@' + channel_username_clean
+    await delete_force_sub_channel(channel_username)
+    await update.callback_query.edit_message_text(
+        f"✅ Channel {channel_username} removed from force-sub list.",
+        parse_mode='HTML',
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("📢 Manage Channels", callback_data="manage_force_sub")]])
+    )
 
-    elif data in ["admin_back", "user_back", "channels_back"]:
-        if user_id == ADMIN_ID:
-            await send_admin_menu(query.message.chat_id, context, query)
-        else:
-            keyboard = [
-                [InlineKeyboardButton("ᴀɴɪᴍᴇ ᴄʜᴀɴɴᴇʟ", url=PUBLIC_ANIME_CHANNEL_URL)],
-                [InlineKeyboardButton("ᴄᴏɴᴛᴀᴄᴛ ᴀᴅᴍɪɴ", url=f"https://t.me/{ADMIN_CONTACT_USERNAME}")],
-                [InlineKeyboardButton("ʀᴇǫᴜᴇsᴛ ᴀɴɪᴍᴇ ᴄʜᴀɴɴᴇʟ", url=REQUEST_CHANNEL_URL)],
-                [
-                    InlineKeyboardButton("ᴀʙᴏᴜᴛ ᴍᴇ", callback_data="about_bot"),
-                    InlineKeyboardButton("ᴄʟᴏsᴇ", callback_data="close_message")
-                ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            try:
-                await query.delete_message()
-            except:
-                pass
-            try:
-                await context.bot.copy_message(
-                    chat_id=query.message.chat_id,
-                    from_chat_id=WELCOME_SOURCE_CHANNEL,
-                    message_id=WELCOME_SOURCE_MESSAGE_ID,
-                    reply_markup=reply_markup
-                )
-            except Exception as e:
-                logger.error(f"Error copying back message: {e}")
-                fallback = "🏠 <b>Main Menu</b>"
-                await context.bot.send_message(query.message.chat_id, fallback, parse_mode='HTML', reply_markup=reply_markup)
-
-    elif data == "about_bot":
-        about_text = (
-            "<b>About Us</b>\n\n"
-            "Developed by @Beat_Anime_Ocean"
-        )
-        keyboard = [[InlineKeyboardButton("🔙 BACK", callback_data="user_back")]]
-        try:
-            await query.delete_message()
-        except:
-            pass
-        await context.bot.send_message(
+async def callback_delete_channel_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    query = update.callback_query
+    channels = await get_all_force_sub_channels()
+    if not channels:
+        await query.answer("No channels to delete!", show_alert=True)
+        return
+    await query.answer()
+
+    text = "🗑️ Choose a channel to delete (set inactive):"
+    keyboard = []
+    for uname, title in channels:
+        keyboard.append([InlineKeyboardButton(title, callback_data=f"delete_{uname.lstrip('@')}")])
+
+    keyboard.append([InlineKeyboardButton("🔙 BACK", callback_data="manage_force_sub")])
+    await query.edit_message_text(text=text, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard))
+
+async def callback_back(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    query = update.callback_query
+    if query.from_user.id == ADMIN_ID:
+        await clear_admin_prompt(update, context)
+        await send_admin_menu(query.message.chat_id, context, query)
+        return
+
+    keyboard = [
+        [InlineKeyboardButton("ᴀɴɪᴍᴇ ᴄʜᴀɴɴᴇʟ", url=PUBLIC_ANIME_CHANNEL_URL)],
+        [InlineKeyboardButton("ᴄᴏɴᴛᴀᴄᴛ ᴀᴅᴍɪɴ", url=f"https://t.me/{ADMIN_CONTACT_USERNAME}")],
+        [InlineKeyboardButton("ʀᴇǫᴜᴇsᴛ ᴀɴɪᴍᴇ ᴄʜᴀɴɴᴇʟ", url=REQUEST_CHANNEL_URL)],
+        [
+            InlineKeyboardButton("ᴀʙᴏᴜᴛ ᴍᴇ", callback_data="about_bot"),
+            InlineKeyboardButton("ᴄʟᴏsᴇ", callback_data="close_message")
+        ]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    try:
+        await query.delete_message()
+    except:
+        pass
+    try:
+        await context.bot.copy_message(
             chat_id=query.message.chat_id,
-            text=about_text,
-            parse_mode='HTML',
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            from_chat_id=WELCOME_SOURCE_CHANNEL,
+            message_id=WELCOME_SOURCE_MESSAGE_ID,
+            reply_markup=reply_markup
         )
+    except Exception as e:
+        logger.error(f"Error copying back message: {e}")
+        fallback = "🏠 <b>Main Menu</b>"
+        await context.bot.send_message(query.message.chat_id, fallback, parse_mode='HTML', reply_markup=reply_markup)
+
+async def callback_about_bot(update: Update, context: ContextTypes.DEFAULT_TYPE, payload):
+    query = update.callback_query
+    about_text = (
+        "<b>About Us</b>\n\n"
+        "Developed by @Beat_Anime_Ocean"
+    )
+    keyboard = [[InlineKeyboardButton("🔙 BACK", callback_data="user_back")]]
+    try:
+        await query.delete_message()
+    except:
+        pass
+    await context.bot.send_message(
+        chat_id=query.message.chat_id,
+        text=about_text,
+        parse_mode='HTML',
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+callback_router = CallbackRouter()
+# User-facing routes
+callback_router.add("verify_subscription", callback_verify_subscription)
+callback_router.add("close_message", callback_close_message)
+callback_router.add("about_bot", callback_about_bot, force_sub=True)
+for back_route in ("admin_back", "user_back", "channels_back"):
+    callback_router.add(back_route, callback_back, force_sub=True)
+# Admin panel
+callback_router.add("admin_stats", callback_admin_stats, admin_only=True)
+callback_router.add("admin_broadcast_start", callback_broadcast_start, admin_only=True)
+callback_router.add("bcast_", callback_broadcast_control, prefix=True, parse=parse_broadcast_action, admin_only=True, answer=False)
+callback_router.add("user_management", callback_user_management, admin_only=True)
+callback_router.add("user_page_", callback_user_page, prefix=True, parse=int, admin_only=True)
+callback_router.add("manage_user_", callback_manage_user, prefix=True, parse=int, admin_only=True)
+callback_router.add("toggle_ban_", callback_toggle_ban, prefix=True, parse=parse_ban_toggle, admin_only=True, answer=False)
+callback_router.add("manage_force_sub", callback_manage_force_sub, admin_only=True)
+callback_router.add("generate_links", callback_generate_links, admin_only=True)
+callback_router.add("add_channel_start", callback_add_channel_start, admin_only=True)
+callback_router.add("channel_", callback_channel_details, prefix=True, parse=parse_channel_username, admin_only=True)
+callback_router.add("delete_channel_prompt", callback_delete_channel_prompt, admin_only=True, answer=False)
+callback_router.add("delete_", callback_delete_channel, prefix=True, parse=parse_channel_username, admin_only=True)
+callback_router.add("confirm_delete_", callback_confirm_delete_channel, prefix=True, parse=parse_channel_username, admin_only=True)
+
+async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await callback_router.dispatch(update, context)
+
+async def get_link_info(link_id):
+    """Returns the generated_links row for a deep link, served from link_info_cache."""
+    link_info = link_info_cache.get(link_id)
+    if link_info is None:
+        link_info = await fetch_link_info(link_id)
+        if link_info:
+            link_info_cache.set(link_id, link_info)
+    return link_info
+
+def normalize_channel_identifier(channel_identifier):
+    """Stored identifiers are @usernames or numeric IDs kept as text."""
+    if isinstance(channel_identifier, str) and channel_identifier.lstrip('-').isdigit():
+        return int(channel_identifier)
+    return channel_identifier
+
+async def get_channel_info(bot, channel_identifier):
+    """Resolves a channel to (chat_id, title), served from channel_info_cache."""
+    channel_info = channel_info_cache.get(channel_identifier)
+    if channel_info is None:
+        chat = await bot.get_chat(channel_identifier)
+        channel_info = (chat.id, chat.title)
+        channel_info_cache.set(channel_identifier, channel_info)
+    return channel_info
 
 async def handle_channel_link_deep(update: Update, context: ContextTypes.DEFAULT_TYPE, link_id):
-    link_info = get_link_info(link_id)
+    link_info = await get_link_info(link_id)
     if not link_info:
         await update.message.reply_text("❌ This link is invalid or not registered.", parse_mode='HTML')
         return
@@ -967,8 +3047,7 @@ async def handle_channel_link_deep(update: Update, context: ContextTypes.DEFAULT
     channel_identifier, creator_id, created_time, never_expires = link_info
 
     try:
-        if isinstance(channel_identifier, str) and channel_identifier.lstrip('-').isdigit():
-            channel_identifier = int(channel_identifier)
+        channel_identifier = normalize_channel_identifier(channel_identifier)
             
         # Check if link has expired (unless it's set to never expire)
         if not never_expires:
@@ -977,20 +3056,20 @@ async def handle_channel_link_deep(update: Update, context: ContextTypes.DEFAULT
                 await update.message.reply_text("❌ This link has expired.", parse_mode='HTML')
                 return
 
-        chat = await context.bot.get_chat(channel_identifier)
-        invite_link = await context.bot.create_chat_invite_link(
-            chat.id,
-            expire_date=datetime.now().timestamp() + LINK_EXPIRY_MINUTES * 60
-        )
+        chat_id, chat_title = await get_channel_info(context.bot, channel_identifier)
+        invite_link, expires_at = await invite_link_pool.get(context.bot, chat_id)
 
-        expiry_text = "Never expires" if never_expires else f"{LINK_EXPIRY_MINUTES} minutes"
+        # A reused invite link has less than the full LINK_EXPIRY_MINUTES left.
+        expiry_text = format_duration(expires_at - time.time())
+        if never_expires:
+            expiry_text += " (bot link never expires)"
         success_message = (
-            f"<b>Channel:</b> {chat.title}\n"
+            f"<b>Channel:</b> {chat_title}\n"
             f"<b>Link Expiry:</b> {expiry_text}\n"
             f"<b>Usage:</b> Multiple use within expiry period\n\n"
             f"Click below:"
         )
-        keyboard = [[InlineKeyboardButton("🔗 Request to Join", url=invite_link.invite_link)]]
+        keyboard = [[InlineKeyboardButton("🔗 Request to Join", url=invite_link)]]
         await update.message.reply_text(
             success_message,
             parse_mode='HTML',
@@ -1000,112 +3079,507 @@ async def handle_channel_link_deep(update: Update, context: ContextTypes.DEFAULT
         logger.error(f"Error generating invite link: {e}")
         await update.message.reply_text("❌ Error creating invite link. Contact admin.", parse_mode='HTML')
 
-async def broadcast_worker_job(context: ContextTypes.DEFAULT_TYPE):
-    """JobQueue worker to send a message to a single chunk of users."""
-    job_data = context.job.data
-    offset = job_data['offset']
-    chunk_size = job_data['chunk_size']
-    message_chat_id = job_data['message_chat_id']
-    message_id = job_data['message_id']
-    is_last_chunk = job_data['is_last_chunk']
-    admin_chat_id = job_data['admin_chat_id']
-
-    users_chunk = get_all_users(limit=chunk_size, offset=offset)
-    sent_count = 0
-    fail_count = 0
-
-    for user in users_chunk:
-        target_user_id = user[0]
-        try:
-            await context.bot.copy_message(
-                chat_id=target_user_id,
-                from_chat_id=message_chat_id,
-                message_id=message_id
-            )
-            sent_count += 1
-        except Exception as e:
-            logger.warning(f"Failed send to {target_user_id} (Offset: {offset}): {e}")
-            fail_count += 1
-        await asyncio.sleep(0.05) 
+# ========== BROADCAST ENGINE ==========
+
+class TokenBucket:
+    """Async token bucket: `rate` tokens per second, bursting up to `capacity`."""
+
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._tokens = capacity
+        self._updated = clock()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+def get_retry_after_seconds(error):
+    """RetryAfter.retry_after is an int or a timedelta depending on the PTB version."""
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+PERMANENT_SEND_ERROR_MARKERS = (
+    'chat not found',
+    'user not found',
+    'user is deactivated',
+    'peer_id_invalid',
+    'bot was blocked',
+    "bot can't initiate conversation",
+)
 
-    logger.info(f"Broadcast chunk from offset {offset} finished. Sent {sent_count} messages, Failed {fail_count}.")
-    
-    await context.bot.send_message(
-        chat_id=admin_chat_id,
-        text=f"✅ **Broadcast Progress:**\nChunk {offset // chunk_size + 1} sent to {sent_count} users (Offset: {offset}). Failed: {fail_count}.",
-        parse_mode='Markdown'
-    )
+def get_permanent_failure_reason(error):
+    """Returns a reason string if the send error means the chat is gone for good."""
+    if isinstance(error, Forbidden):
+        return error.message
+    if isinstance(error, BadRequest):
+        message = error.message.lower()
+        if any(marker in message for marker in PERMANENT_SEND_ERROR_MARKERS):
+            return error.message
+    return None
 
-    if is_last_chunk:
-        total_users = get_user_count() 
-        await context.bot.send_message(
-            chat_id=admin_chat_id,
-            text=f"🎉 **BROADCAST COMPLETE!**\nTotal users attempted: {total_users}.",
-            parse_mode='Markdown'
-        )
+class BroadcastEngine:
+    """Sends one message to many chats with a pool of concurrent senders.
 
-async def broadcast_message_to_all_users(update: Update, context: ContextTypes.DEFAULT_TYPE, message_to_copy):
-    admin_chat_id = update.effective_chat.id
-    total_users = get_user_count()
-
-    if total_users < BROADCAST_MIN_USERS:
-        await update.message.reply_text(f"🔄 Broadcasting to {total_users} users (below threshold, no block delay)...", parse_mode='HTML')
-        sent = 0
-        all_users = get_all_users(limit=None, offset=0)
-        for u in all_users:
-            target = u[0]
+    All senders share a global token bucket (Telegram allows ~30 msg/s in
+    bulk) and a per-chat minimum interval. A RetryAfter from any sender
+    pauses every sender for the requested time; transient network errors
+    are retried with exponential backoff plus jitter. Chats that fail
+    permanently (blocked, deactivated, not found) are collected in
+    `unreachable` for the caller to persist. The bot is only used
+    through `copy_message`, so any object with that coroutine can stand in.
+    """
+
+    def __init__(self, bot, from_chat_id, message_id, rate=None, workers=None,
+                 per_chat_interval=None, max_retries=None):
+        self.bot = bot
+        self.from_chat_id = from_chat_id
+        self.message_id = message_id
+        rate = rate or BROADCAST_RATE_LIMIT
+        self.bucket = TokenBucket(rate, max(1, rate))
+        self.workers = workers or BROADCAST_WORKERS
+        self.per_chat_interval = BROADCAST_PER_CHAT_INTERVAL if per_chat_interval is None else per_chat_interval
+        self.max_retries = BROADCAST_MAX_RETRIES if max_retries is None else max_retries
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+        self.unreachable = {}
+        self.retries = 0
+        self.rate_limited = 0
+        self.last_user_id = None
+        self.committed_user_id = None
+        self.stop_requested = False
+        self.started_at = None
+        self._paused_until = 0.0
+        self._chat_next_send = {}
+        self._in_flight = OrderedDict()
+
+    async def _wait_for_global_pause(self):
+        while True:
+            delay = self._paused_until - time.monotonic()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    async def _wait_for_chat(self, chat_id):
+        delay = self._chat_next_send.get(chat_id, 0.0) - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self._chat_next_send[chat_id] = time.monotonic() + self.per_chat_interval
+
+    async def send_one(self, chat_id):
+        """Delivers to one chat. Returns None on success or the final error.
+
+        Network errors use up one of max_retries attempts. A RetryAfter only
+        waits out Telegram's delay (with every other sender) and counts
+        against the separate, much higher BROADCAST_MAX_FLOOD_WAITS, so a
+        rate-limit episode doesn't fail recipients.
+        """
+        attempt = 0
+        flood_waits = 0
+        while True:
+            await self._wait_for_global_pause()
+            await self._wait_for_chat(chat_id)
+            await self.bucket.acquire()
             try:
-                await context.bot.copy_message(chat_id=target, from_chat_id=message_to_copy.chat_id, message_id=message_to_copy.message_id)
-                sent += 1
+                await self.bot.copy_message(
+                    chat_id=chat_id,
+                    from_chat_id=self.from_chat_id,
+                    message_id=self.message_id
+                )
+                return None
+            except RetryAfter as e:
+                delay = get_retry_after_seconds(e)
+                self.rate_limited += 1
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                logger.warning(f"Broadcast rate limited by Telegram, pausing all senders for {delay:.1f}s")
+                flood_waits += 1
+                if flood_waits > BROADCAST_MAX_FLOOD_WAITS:
+                    return e
+                continue
+            except BadRequest as e:
+                return e
+            except (TimedOut, NetworkError) as e:
+                error = e
             except Exception as e:
-                logger.warning(f"Failed send to {target}: {e}")
-            await asyncio.sleep(0.05)
-        await context.bot.send_message(chat_id=admin_chat_id, text=f"✅ **Broadcast Complete!**\nTotal attempted: {total_users}.\nSuccessfully sent: {sent}.", parse_mode='Markdown')
-        try: await update.message.delete()
-        except: pass
-        return
+                return e
+
+            attempt += 1
+            if attempt > self.max_retries:
+                return error
+            self.retries += 1
+            backoff = BROADCAST_RETRY_BASE_DELAY * (2 ** (attempt - 1))
+            await asyncio.sleep(backoff + random.uniform(0, BROADCAST_RETRY_BASE_DELAY))
+
+    async def _worker(self, queue):
+        while True:
+            chat_id = await queue.get()
+            try:
+                if chat_id is None:
+                    return
+                error = await self.send_one(chat_id)
+                if error is None:
+                    self.sent += 1
+                else:
+                    self.failed += 1
+                    reason = get_permanent_failure_reason(error)
+                    if reason:
+                        self.blocked += 1
+                        self.unreachable[chat_id] = reason
+                    else:
+                        logger.warning(f"Failed send to {chat_id}: {error}")
+                self._mark_done(chat_id)
+            finally:
+                queue.task_done()
+
+    def stop(self):
+        """Stops feeding new chats; sends already queued still complete."""
+        self.stop_requested = True
+
+    def throughput(self):
+        """Attempted sends per second since run() started."""
+        if self.started_at is None:
+            return 0.0
+        elapsed = time.monotonic() - self.started_at
+        return (self.sent + self.failed) / elapsed if elapsed > 0 else 0.0
+
+    def _mark_done(self, chat_id):
+        """Advances committed_user_id past every leading chat that has finished."""
+        self._in_flight[chat_id] = True
+        while self._in_flight:
+            first_id, done = next(iter(self._in_flight.items()))
+            if not done:
+                break
+            self._in_flight.popitem(last=False)
+            self.committed_user_id = first_id
+
+    async def _checkpoint_loop(self, on_checkpoint, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await on_checkpoint(self)
+            except Exception as e:
+                logger.error(f"Broadcast checkpoint failed: {e}")
+
+    async def run(self, user_ids, on_checkpoint=None, checkpoint_interval=None):
+        """Sends to every chat ID from the (async) iterable; returns (sent, failed).
+
+        `on_checkpoint(engine)` is awaited every checkpoint_interval seconds
+        and once at the end. Every chat at or below engine.committed_user_id
+        has been attempted, so it is a safe cursor to resume from.
+        """
+        self.started_at = time.monotonic()
+        queue = asyncio.Queue(maxsize=self.workers * 2)
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.workers)]
+        checkpointer = None
+        if on_checkpoint:
+            checkpointer = asyncio.create_task(
+                self._checkpoint_loop(on_checkpoint, checkpoint_interval or BROADCAST_CHECKPOINT_INTERVAL)
+            )
+        try:
+            async for chat_id in user_ids:
+                if self.stop_requested:
+                    break
+                self.last_user_id = chat_id
+                self._in_flight[chat_id] = False
+                await queue.put(chat_id)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            if checkpointer:
+                checkpointer.cancel()
+        if on_checkpoint:
+            await on_checkpoint(self)
+        return self.sent, self.failed
+
+def schedule_broadcast_campaign(job_queue, campaign_id, when=0, failures=0):
+    job_queue.run_once(
+        broadcast_worker_job,
+        when=when,
+        data={'campaign_id': campaign_id, 'failures': failures},
+        name=f"broadcast_campaign_{campaign_id}"
+    )
 
-    await update.message.reply_text(
-        f"⏳ **Throttled Broadcast Started!**\n"
-        f"Total users: {total_users}.\n"
-        f"Sending in chunks of {BROADCAST_CHUNK_SIZE} every {BROADCAST_INTERVAL_MIN} minutes.",
-        parse_mode='Markdown'
+def unschedule_broadcast_campaign(job_queue, campaign_id):
+    for job in job_queue.get_jobs_by_name(f"broadcast_campaign_{campaign_id}"):
+        job.schedule_removal()
+
+# Engines of campaigns currently sending, so pause/cancel can stop them.
+active_broadcasts = {}
+
+def stop_active_broadcasts():
+    """Stops every local engine; their campaigns stay 'running' and resume from the cursor."""
+    for engine in active_broadcasts.values():
+        engine.stop()
+
+BROADCAST_STATUS_LABELS = {
+    'running': "🟢 RUNNING",
+    'paused': "⏸️ PAUSED",
+    'cancelled': "⛔ CANCELLED",
+    'completed': "🎉 COMPLETE",
+}
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}h {minutes}m"
+    if minutes:
+        return f"{minutes}m {seconds}s"
+    return f"{seconds}s"
+
+def build_broadcast_status(campaign, rate=None):
+    """Renders the live status message text and keyboard for a campaign dict."""
+    campaign_id = campaign['campaign_id']
+    status = campaign['status']
+    sent = campaign['sent_count']
+    failed = campaign['failed_count']
+    blocked = campaign['blocked_count']
+    total = campaign['total_estimate'] or 0
+    processed = sent + failed
+
+    if status == 'running' and rate:
+        eta = format_duration(max(0, total - processed) / rate)
+    else:
+        eta = "—"
+    throughput = f"{rate:.1f} msg/s" if rate else "—"
+
+    text = (
+        f"📣 <b>BROADCAST #{campaign_id}</b> — {BROADCAST_STATUS_LABELS.get(status, status)}\n\n"
+        f"📊 Progress: {processed}/{total}\n"
+        f"✅ Sent: {sent}\n"
+        f"❌ Failed: {failed} (🚫 blocked: {blocked})\n"
+        f"⚡ Throughput: {throughput}\n"
+        f"⏱️ ETA: {eta}\n"
+        f"📍 Cursor: <code>{campaign['last_user_id']}</code>"
     )
 
-    offset = 0
-    current_delay = 0 
-    chunks_sent = 0
-    total_chunks = (total_users + BROADCAST_CHUNK_SIZE - 1) // BROADCAST_CHUNK_SIZE
+    if status == 'running':
+        buttons = [[
+            InlineKeyboardButton("⏸️ PAUSE", callback_data=f"bcast_pause_{campaign_id}"),
+            InlineKeyboardButton("⛔ CANCEL", callback_data=f"bcast_cancel_{campaign_id}"),
+        ]]
+    elif status == 'paused':
+        buttons = [[
+            InlineKeyboardButton("▶️ RESUME", callback_data=f"bcast_resume_{campaign_id}"),
+            InlineKeyboardButton("⛔ CANCEL", callback_data=f"bcast_cancel_{campaign_id}"),
+        ]]
+    else:
+        buttons = []
+    return text, InlineKeyboardMarkup(buttons)
 
-    while offset < total_users:
-        is_last_chunk = (offset + BROADCAST_CHUNK_SIZE) >= total_users
-        
-        job_data = {
-            'offset': offset,
-            'chunk_size': BROADCAST_CHUNK_SIZE,
-            'message_chat_id': message_to_copy.chat_id,
-            'message_id': message_to_copy.message_id,
-            'is_last_chunk': is_last_chunk,
-            'admin_chat_id': admin_chat_id,
+async def edit_broadcast_status(bot, campaign, rate=None):
+    if not campaign['status_message_id']:
+        return
+    text, reply_markup = build_broadcast_status(campaign, rate)
+    try:
+        await bot.edit_message_text(
+            chat_id=campaign['admin_chat_id'],
+            message_id=campaign['status_message_id'],
+            text=text,
+            parse_mode='HTML',
+            reply_markup=reply_markup
+        )
+    except BadRequest as e:
+        if 'not modified' not in e.message.lower():
+            logger.warning(f"Could not update broadcast {campaign['campaign_id']} status: {e}")
+    except Exception as e:
+        logger.warning(f"Could not update broadcast {campaign['campaign_id']} status: {e}")
+
+async def broadcast_worker_job(context: ContextTypes.DEFAULT_TYPE):
+    """JobQueue worker that sends the next chunk of a persisted broadcast campaign.
+
+    Progress (last user_id reached, sent/failed totals) is checkpointed to
+    broadcast_campaigns while sending, so a restart resumes from the cursor
+    instead of starting over. Campaigns with a chunk_size schedule their next
+    chunk BROADCAST_INTERVAL_MIN minutes later; the others send in one run.
+    The admin's status message is edited at most every
+    BROADCAST_STATUS_EDIT_INTERVAL seconds.
+    """
+    campaign_id = context.job.data['campaign_id']
+    if campaign_id in active_broadcasts:
+        return
+    campaign = await get_broadcast_campaign(campaign_id)
+    if not campaign:
+        logger.warning(f"Broadcast campaign {campaign_id} no longer exists.")
+        return
+    if campaign['status'] != 'running':
+        return
+
+    chunk_size = campaign['chunk_size']
+    after_user_id = campaign['last_user_id']
+    base = dict(campaign)
+    last_edit = 0.0
+
+    def snapshot(engine):
+        return {
+            **base,
+            'last_user_id': engine.committed_user_id or after_user_id,
+            'sent_count': base['sent_count'] + engine.sent,
+            'failed_count': base['failed_count'] + engine.failed,
+            'blocked_count': base['blocked_count'] + engine.blocked,
         }
-        
-        context.job_queue.run_once(
-            broadcast_worker_job, 
-            when=current_delay, 
-            data=job_data,
-            name=f"broadcast_chunk_{chunks_sent}"
+
+    async def checkpoint(engine):
+        nonlocal last_edit
+        if engine.unreachable:
+            unreachable, engine.unreachable = engine.unreachable, {}
+            await mark_users_unreachable(unreachable)
+            user_upsert_queue.forget(unreachable)
+        latest = await get_broadcast_campaign(campaign_id)
+        if latest and latest['status'] != 'running':
+            # Paused or cancelled from another worker's status message.
+            engine.stop()
+        if engine.committed_user_id is None:
+            return
+        current = snapshot(engine)
+        await update_broadcast_campaign(
+            campaign_id,
+            last_user_id=current['last_user_id'],
+            sent_count=current['sent_count'],
+            failed_count=current['failed_count'],
+            blocked_count=current['blocked_count']
         )
+        if time.monotonic() - last_edit >= BROADCAST_STATUS_EDIT_INTERVAL:
+            last_edit = time.monotonic()
+            await edit_broadcast_status(context.bot, current, engine.throughput())
+
+    engine = BroadcastEngine(context.bot, campaign['message_chat_id'], campaign['message_id'])
+    active_broadcasts[campaign_id] = engine
+    try:
+        sent_count, fail_count = await engine.run(
+            iter_broadcast_user_ids(after_user_id, limit=chunk_size),
+            on_checkpoint=checkpoint
+        )
+    except Exception as e:
+        failures = context.job.data.get('failures', 0) + 1
+        delay = min(BROADCAST_FAILURE_MAX_BACKOFF, BROADCAST_FAILURE_BACKOFF * 2 ** (failures - 1))
+        logger.error(f"Broadcast {campaign_id} failed ({e}); retrying in {delay:.0f}s.")
+        try:
+            await checkpoint(engine)
+        except Exception as checkpoint_error:
+            logger.error(f"Could not checkpoint broadcast {campaign_id}: {checkpoint_error}")
+        if runs_leader_jobs() and not shutting_down.is_set():
+            schedule_broadcast_campaign(context.job_queue, campaign_id, when=delay, failures=failures)
+        return
+    finally:
+        active_broadcasts.pop(campaign_id, None)
 
-        offset += BROADCAST_CHUNK_SIZE
-        current_delay += BROADCAST_INTERVAL_MIN * 60 
-        chunks_sent += 1
+    logger.info(f"Broadcast {campaign_id} chunk {campaign['chunk_number']} (after user {after_user_id}) finished. Sent {sent_count} messages, Failed {fail_count}.")
 
-    await update.message.reply_text(
-        f"Scheduled **{total_chunks}** broadcast chunks, running over **{current_delay // 60} minutes**.\n"
-        f"You will receive a notification after each chunk is sent.",
-        parse_mode='Markdown'
+    if engine.stop_requested:
+        # Paused or cancelled from the status message. If it was resumed
+        # while this run was still draining, pick up where it stopped.
+        final = await get_broadcast_campaign(campaign_id)
+        await edit_broadcast_status(context.bot, final)
+        if final['status'] == 'running' and runs_leader_jobs() and not shutting_down.is_set():
+            schedule_broadcast_campaign(context.job_queue, campaign_id)
+        return
+
+    current = snapshot(engine)
+    if chunk_size is None or sent_count + fail_count < chunk_size:
+        await update_broadcast_campaign(campaign_id, status='completed')
+        current['status'] = 'completed'
+        await edit_broadcast_status(context.bot, current, engine.throughput())
+        return
+
+    delay = BROADCAST_INTERVAL_MIN * 60
+    await update_broadcast_campaign(
+        campaign_id,
+        chunk_number=campaign['chunk_number'] + 1,
+        next_run_at=datetime.now() + timedelta(seconds=delay)
     )
-    
+    await edit_broadcast_status(context.bot, current, engine.throughput())
+    schedule_broadcast_campaign(context.job_queue, campaign_id, when=delay)
+
+async def resume_broadcast_campaigns(context: ContextTypes.DEFAULT_TYPE):
+    """Reschedules campaigns left running by a restart, redeploy or /reload.
+
+    A scale-out leader runs this every BROADCAST_POLL_INTERVAL to also pick up
+    campaigns started from other workers.
+    """
+    for campaign_id, next_run_at in await get_unfinished_broadcast_campaigns():
+        if campaign_id in active_broadcasts or context.job_queue.get_jobs_by_name(f"broadcast_campaign_{campaign_id}"):
+            continue
+        delay = max(0, (next_run_at - datetime.now()).total_seconds()) if next_run_at else 0
+        logger.info(f"Resuming broadcast campaign {campaign_id} in {delay:.0f}s.")
+        schedule_broadcast_campaign(context.job_queue, campaign_id, when=delay)
+
+async def handle_broadcast_control(query, context, broadcast_action):
+    """Handles the PAUSE / RESUME / CANCEL buttons on a broadcast status message."""
+    action, campaign_id = broadcast_action
+
+    campaign = await get_broadcast_campaign(campaign_id)
+    if not campaign:
+        await query.answer("Broadcast not found.", show_alert=True)
+        return
+
+    status = campaign['status']
+    engine = active_broadcasts.get(campaign_id)
+
+    if action == "pause" and status == 'running':
+        new_status = 'paused'
+    elif action == "resume" and status == 'paused':
+        new_status = 'running'
+    elif action == "cancel" and status in ('running', 'paused'):
+        new_status = 'cancelled'
+    else:
+        await query.answer(f"Broadcast is {status}.", show_alert=True)
+        return
+
+    await update_broadcast_campaign(campaign_id, status=new_status)
+    campaign['status'] = new_status
+
+    if new_status == 'running':
+        unschedule_broadcast_campaign(context.job_queue, campaign_id)
+        if runs_leader_jobs():
+            schedule_broadcast_campaign(context.job_queue, campaign_id)
+    elif engine:
+        # The worker stops feeding recipients, checkpoints and redraws the status.
+        engine.stop()
+    else:
+        unschedule_broadcast_campaign(context.job_queue, campaign_id)
+
+    await query.answer(f"Broadcast {new_status}.")
+    await edit_broadcast_status(context.bot, campaign)
+    logger.info(f"Broadcast {campaign_id} {new_status} by admin.")
+
+async def broadcast_message_to_all_users(update: Update, context: ContextTypes.DEFAULT_TYPE, message_to_copy):
+    admin_chat_id = update.effective_chat.id
+    total_users = await get_user_count(reachable_only=True)
+    chunk_size = BROADCAST_CHUNK_SIZE if total_users >= BROADCAST_MIN_USERS else None
+
+    campaign_id = await create_broadcast_campaign(
+        admin_chat_id, message_to_copy.chat_id, message_to_copy.message_id,
+        chunk_size=chunk_size, total_estimate=total_users
+    )
+    campaign = await get_broadcast_campaign(campaign_id)
+    text, reply_markup = build_broadcast_status(campaign)
+    status_message = await context.bot.send_message(
+        chat_id=admin_chat_id, text=text, parse_mode='HTML', reply_markup=reply_markup
+    )
+    await update_broadcast_campaign(campaign_id, status_message_id=status_message.message_id)
+    # In scale-out mode the leader's resume_broadcast_campaigns poll picks it up.
+    if runs_leader_jobs():
+        schedule_broadcast_campaign(context.job_queue, campaign_id)
+
     try: await update.message.delete()
     except: pass
 
@@ -1116,8 +3590,7 @@ async def send_admin_menu(chat_id, context, query=None):
         except:
             pass
             
-    context.user_data.pop('bot_prompt_message_id', None)
-    user_states.pop(chat_id, None) 
+    await conversation_store.reset(chat_id)
     
     keyboard = [
         [InlineKeyboardButton("📊 BOT STATS", callback_data="admin_stats")],
@@ -1135,14 +3608,7 @@ async def send_admin_stats(query, context):
         await query.delete_message()
     except:
         pass
-    user_count = get_user_count()
-    channel_count = len(get_all_force_sub_channels()) 
-    stats_text = (
-        "📊 <b>BOT STATISTICS</b>\n\n"
-        f"👤 Total Users: {user_count}\n"
-        f"📢 Force Sub Channels: {channel_count}\n"
-        f"🔗 Link Expiry: {LINK_EXPIRY_MINUTES} minutes"
-    )
+    stats_text = await build_stats_text()
     keyboard = [
         [InlineKeyboardButton("🔄 REFRESH", callback_data="admin_stats")],
         [InlineKeyboardButton("🔙 BACK", callback_data="admin_back")]
@@ -1150,7 +3616,7 @@ async def send_admin_stats(query, context):
     await context.bot.send_message(chat_id=query.message.chat_id, text=stats_text, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard))
 
 async def show_force_sub_management(query, context):
-    channels = get_all_force_sub_channels(return_usernames_only=False)
+    channels = await get_all_force_sub_channels(return_usernames_only=False)
     channels_text = "📢 <b>FORCE SUBSCRIPTION CHANNELS</b>\n\n"
     if not channels:
         channels_text += "No channels configured."
@@ -1176,7 +3642,7 @@ async def show_force_sub_management(query, context):
 
 async def show_channel_details(query, context, channel_username_clean):
     channel_username = '@' + channel_username_clean
-    channel_info = get_force_sub_channel_info(channel_username)
+    channel_info = await get_force_sub_channel_info(channel_username)
     if not channel_info:
         await query.edit_message_text(
             "❌ Channel not found.",
@@ -1200,7 +3666,7 @@ async def show_channel_details(query, context, channel_username_clean):
 
 async def send_single_user_management(query, context, target_user_id):
     """Shows details and ban/unban buttons for a single user."""
-    user_info = get_user_info_by_id(target_user_id)
+    user_info = await get_user_info_by_id(target_user_id)
     
     if not user_info:
         await query.edit_message_text(
@@ -1243,13 +3709,14 @@ async def send_user_management(query, context, offset=0):
         await query.answer("You are not authorized", show_alert=True)
         return
     
-    total = get_user_count()
-    users = get_all_users(limit=10, offset=offset) 
-    has_next = total > offset + 10
+    total = await get_user_count()
+    users = await get_all_users(limit=11, offset=offset) 
+    has_next = len(users) > 10
+    users = users[:10]
     has_prev = offset > 0
     
     text = f"👤 <b>USER MANAGEMENT</b>\n\n"
-    text += f"Showing {offset+1}-{min(offset+10, total)} of {total} total users.\n\n"
+    text += f"Showing {offset+1}-{offset+len(users)} of {total} total users.\n\n"
     
     management_keyboard = []
 
@@ -1282,27 +3749,583 @@ async def send_user_management(query, context, offset=0):
     await query.edit_message_text(text=text, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(final_keyboard))
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    metrics.inc('update_errors_total', error=type(context.error).__name__)
     logger.error(f"Exception in update: {context.error}")
 
+async def rotate_invite_links_job(context: ContextTypes.DEFAULT_TYPE):
+    """Keeps a fresh invite link ready for every channel used by a deep link."""
+    channels = await get_linked_channel_identifiers()
+    await asyncio.gather(*(
+        invite_link_pool.prewarm(context.bot, normalize_channel_identifier(ch)) for ch in channels
+    ))
+
+cleanup_stats = {'runs': 0, 'last_deleted': 0, 'last_duration': 0.0, 'total_deleted': 0, 'backlog': False}
+
 async def cleanup_task(context: ContextTypes.DEFAULT_TYPE):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cutoff = datetime.now() - timedelta(days=7)
-    # Only delete expired links that are not set to never expire
-    cursor.execute('DELETE FROM generated_links WHERE created_time < %s AND never_expires = FALSE', (cutoff,))
-    conn.commit()
-    conn.close()
+    """Sweeps expired generated_links in bounded batches and reschedules itself.
 
-def keep_alive():
-    while True:
-        time.sleep(840)
+    Each batch is its own transaction and the sweeper sleeps between batches,
+    so it never holds long locks. A run stops after CLEANUP_MAX_BATCHES; if
+    rows were still left it comes back after CLEANUP_MIN_INTERVAL instead of
+    the usual CLEANUP_INTERVAL. Expired admin conversation state is purged
+    on the same schedule.
+    """
+    start = time.monotonic()
+    cutoff = datetime.now() - timedelta(days=LINK_RETENTION_DAYS)
+    try:
+        expired_conversations = await conversation_store.purge_expired()
+        if expired_conversations:
+            logger.info(f"Dropped {expired_conversations} abandoned admin conversation(s).")
+    except Exception as e:
+        logger.error(f"Conversation state cleanup failed: {e}")
+
+    deleted = 0
+    backlog = False
+    try:
+        for _ in range(CLEANUP_MAX_BATCHES):
+            batch_deleted = await delete_expired_links(cutoff, CLEANUP_BATCH_SIZE)
+            deleted += batch_deleted
+            if batch_deleted < CLEANUP_BATCH_SIZE:
+                break
+            await asyncio.sleep(CLEANUP_BATCH_PAUSE)
+        else:
+            backlog = True
+    except Exception as e:
+        logger.error(f"Link cleanup failed after removing {deleted} rows: {e}")
+
+    duration = time.monotonic() - start
+    cleanup_stats.update(
+        runs=cleanup_stats['runs'] + 1,
+        last_deleted=deleted,
+        last_duration=duration,
+        total_deleted=cleanup_stats['total_deleted'] + deleted,
+        backlog=backlog,
+    )
+    if deleted:
+        logger.info(f"Link cleanup removed {deleted} rows in {duration:.2f}s{' (backlog remains)' if backlog else ''}.")
+    # Not after losing leadership mid-run (the new leader runs its own chain)
+    # or once shutdown has started.
+    if runs_leader_jobs() and not shutting_down.is_set():
+        context.job_queue.run_once(
+            cleanup_task,
+            when=CLEANUP_MIN_INTERVAL if backlog else CLEANUP_INTERVAL,
+            name="cleanup_task"
+        )
+
+async def reconcile_ban_list(context: ContextTypes.DEFAULT_TYPE):
+    """Reloads the in-memory ban list to catch bans edited directly in the DB."""
+    version = ban_list.version
+    user_ids = await load_banned_user_ids()
+    if ban_list.replace(user_ids, version):
+        logger.info(f"Ban list reconciled: {len(ban_list)} banned users.")
+    else:
+        logger.info("Ban list changed during reconcile; will retry on next run.")
+
+# ========== SCALE-OUT (INGRESS / WORKERS) ==========
+
+# Arbitrary advisory lock keys, next to MIGRATIONS_LOCK_ID.
+LEADER_LOCK_ID = 7_301_415_002
+SHARD_LOCK_BASE = 7_301_416_000
+
+class AdvisoryLock:
+    """A Postgres session advisory lock held on a dedicated connection.
+
+    The lock lives exactly as long as that connection: a crashed or cut-off
+    holder loses it and another process can take over. Methods block, so
+    call them through db_executor.
+    """
+
+    def __init__(self, lock_id):
+        self.lock_id = lock_id
+        self.held = False
+        self._conn = None
+
+    def try_acquire(self):
+        """Returns True while this process holds the lock, acquiring it if free."""
+        if self.held:
+            return self.still_held()
+        if self._conn is None or self._conn.closed:
+            self._conn = psycopg2.connect(
+                DATABASE_URL, connect_timeout=10,
+                keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3
+            )
+            self._conn.autocommit = True
+        with self._conn.cursor() as cursor:
+            cursor.execute('SELECT pg_try_advisory_lock(%s)', (self.lock_id,))
+            self.held = cursor.fetchone()[0]
+        return self.held
+
+    def still_held(self):
         try:
-            requests.get("https://www.google.com/robots.txt", timeout=10)
-        except:
+            with self._conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+        except psycopg2.Error:
+            self.release()
+        return self.held
+
+    def release(self):
+        self.held = False
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except psycopg2.Error:
+                pass
+        self._conn = None
+
+leader_lock = AdvisoryLock(LEADER_LOCK_ID) if BOT_ROLE == 'worker' else None
+shard_lock = AdvisoryLock(SHARD_LOCK_BASE + WORKER_SHARD) if BOT_ROLE == 'worker' else None
+
+class CacheInvalidationListener:
+    """Applies other workers' ban, channel and reachability changes from Postgres NOTIFY."""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.applied = 0
+        self._conn = None
+
+    def connect(self):
+        self._conn = psycopg2.connect(
+            DATABASE_URL, connect_timeout=10,
+            keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3
+        )
+        self._conn.autocommit = True
+        with self._conn.cursor() as cursor:
+            cursor.execute(f'LISTEN "{self.channel}"')
+
+    def ping(self):
+        with self._conn.cursor() as cursor:
+            cursor.execute('SELECT 1')
+
+    def close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except psycopg2.Error:
+                pass
+        self._conn = None
+
+    def apply(self, payload):
+        kind, _, ids = payload.partition(':')
+        user_ids = [int(x) for x in ids.split(',')] if ids else []
+        if kind == 'ban':
+            for user_id in user_ids:
+                ban_list.add(user_id)
+        elif kind == 'unban':
+            for user_id in user_ids:
+                ban_list.discard(user_id)
+        elif kind == 'channels':
+            force_sub_channel_cache.invalidate()
+        elif kind == 'forget_profiles':
+            user_upsert_queue.forget(user_ids)
+        else:
+            logger.warning(f"Ignoring unknown cache invalidation {payload!r}")
+            return
+        self.applied += 1
+        metrics.inc('cache_invalidations_total', kind=kind)
+
+    async def resync(self):
+        force_sub_channel_cache.invalidate()
+        user_upsert_queue.recent_profiles.clear()
+        await load_ban_list()
+
+    async def run(self):
+        """Listens until cancelled, reconnecting with backoff when the connection drops."""
+        loop = asyncio.get_running_loop()
+        backoff = 1
+        while True:
+            try:
+                await loop.run_in_executor(db_executor, self.connect)
+                await self.resync()
+            except Exception as e:
+                self.close()
+                logger.warning(f"Cache invalidation listener could not connect, retrying in {backoff}s: {e}")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+                continue
+            backoff = 1
+            readable = asyncio.Event()
+            fd = self._conn.fileno()
+            loop.add_reader(fd, readable.set)
+            try:
+                while True:
+                    try:
+                        await asyncio.wait_for(readable.wait(), LEADER_ELECTION_INTERVAL)
+                    except asyncio.TimeoutError:
+                        # Quiet channel: make sure the connection is still there.
+                        await loop.run_in_executor(db_executor, self.ping)
+                    readable.clear()
+                    self._conn.poll()
+                    while self._conn.notifies:
+                        self.apply(self._conn.notifies.pop(0).payload)
+            except psycopg2.Error as e:
+                logger.warning(f"Cache invalidation listener lost its connection: {e}")
+            finally:
+                loop.remove_reader(fd)
+                self.close()
+
+cache_invalidation_listener = CacheInvalidationListener(CACHE_INVALIDATION_CHANNEL) if BOT_ROLE == 'worker' else None
+
+LEADER_JOB_NAMES = ("cleanup_task", "rotate_invite_links", "resume_broadcast_campaigns")
+
+def runs_leader_jobs():
+    """True in standalone mode, or in the worker currently holding the leader lock."""
+    return leader_lock is None or leader_lock.held
+
+def start_leader_jobs(job_queue, poll_broadcasts=False):
+    """Schedules the jobs that must run in exactly one process.
+
+    A scale-out leader keeps polling for campaigns, since they may have been
+    started from another worker.
+    """
+    job_queue.run_once(cleanup_task, 10, name="cleanup_task")
+    job_queue.run_repeating(rotate_invite_links_job, interval=INVITE_LINK_ROTATION_INTERVAL, first=1, name="rotate_invite_links")
+    if poll_broadcasts:
+        job_queue.run_repeating(resume_broadcast_campaigns, interval=BROADCAST_POLL_INTERVAL, first=1, name="resume_broadcast_campaigns")
+    else:
+        job_queue.run_once(resume_broadcast_campaigns, 5, name="resume_broadcast_campaigns")
+
+def stop_leader_jobs(job_queue):
+    """Drops leader-only jobs and stops local broadcasts after losing leadership."""
+    for job in job_queue.jobs():
+        if job.name in LEADER_JOB_NAMES or job.name.startswith("broadcast_campaign_"):
+            job.schedule_removal()
+    stop_active_broadcasts()
+
+async def leader_election_job(context: ContextTypes.DEFAULT_TYPE):
+    """Tries to take (or confirms) the leader lock and starts/stops leader jobs to match."""
+    was_leader = leader_lock.held
+    try:
+        is_leader = await asyncio.get_running_loop().run_in_executor(db_executor, leader_lock.try_acquire)
+    except Exception as e:
+        logger.warning(f"Leader election failed: {e}")
+        leader_lock.release()
+        is_leader = False
+
+    if is_leader and not was_leader:
+        logger.info("Elected leader: running periodic jobs in this worker.")
+        start_leader_jobs(context.job_queue, poll_broadcasts=True)
+    elif was_leader and not is_leader:
+        logger.warning("Lost leadership: stopping periodic jobs in this worker.")
+        stop_leader_jobs(context.job_queue)
+
+def update_shard(update):
+    """Shard for an update: by user, so one user's updates stay in order on one worker."""
+    key = update.effective_user.id if update.effective_user else (update.effective_chat.id if update.effective_chat else 0)
+    return key % WORKER_SHARDS
+
+async def consume_shared_updates(application: Application, stop_event):
+    """Worker loop: owns shard WORKER_SHARD of update_queue and feeds it to the local Application.
+
+    Ownership is the shard's advisory lock, so a second worker started for
+    the same shard stands by until the first one goes away. Polling speeds
+    up while updates are flowing and backs off to
+    SHARED_QUEUE_MAX_POLL_INTERVAL when idle.
+    """
+    loop = asyncio.get_running_loop()
+    interval = SHARED_QUEUE_MAX_POLL_INTERVAL
+    next_lock_check = 0.0
+    while not stop_event.is_set():
+        payloads = []
+        try:
+            if time.monotonic() >= next_lock_check:
+                next_lock_check = time.monotonic() + LEADER_ELECTION_INTERVAL
+                owned_before = shard_lock.held
+                if await loop.run_in_executor(db_executor, shard_lock.try_acquire):
+                    if not owned_before:
+                        logger.info(f"Consuming update shard {WORKER_SHARD}/{WORKER_SHARDS}.")
+                elif owned_before:
+                    logger.warning(f"Lost update shard {WORKER_SHARD}; standing by.")
+            if shard_lock.held:
+                payloads = await claim_queued_updates(WORKER_SHARD, SHARED_QUEUE_BATCH_SIZE)
+        except Exception as e:
+            logger.error(f"Shared update queue poll failed: {e}")
+
+        for payload in payloads:
+            await application.update_queue.put(Update.de_json(payload, application.bot))
+        if payloads:
+            metrics.inc('shared_queue_claimed_total', len(payloads))
+
+        if len(payloads) == SHARED_QUEUE_BATCH_SIZE:
+            continue
+        interval = SHARED_QUEUE_MIN_POLL_INTERVAL if payloads else min(interval * 2, SHARED_QUEUE_MAX_POLL_INTERVAL)
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+
+# ========== UPDATE PROCESSING ==========
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Runs different users' updates concurrently and each user's updates in order."""
+
+    def __init__(self, concurrency, per_user_max_pending):
+        super().__init__(max_concurrent_updates=2**31 - 1)
+        self.concurrency = concurrency
+        self.per_user_max_pending = per_user_max_pending
+        self._slots = asyncio.Semaphore(concurrency)
+        self._user_locks = {}
+        self._user_pending = {}
+        self.waiting = 0
+        self.running = 0
+        self.dropped = 0
+
+    @staticmethod
+    def serialization_key(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self.serialization_key(update)
+        if key is not None and self._user_pending.get(key, 0) >= self.per_user_max_pending:
+            self.dropped += 1
+            metrics.inc('updates_dropped_total', reason='user_backlog')
+            logger.warning(f"Dropping update from {key}: {self.per_user_max_pending} already queued.")
+            coroutine.close()
+            return
+
+        queued_at = time.monotonic()
+        self.waiting += 1
+        lock = None
+        if key is not None:
+            self._user_pending[key] = self._user_pending.get(key, 0) + 1
+            lock = self._user_locks.setdefault(key, asyncio.Lock())
+        started = False
+        try:
+            async with lock or nullcontext():
+                if not startup_ready.is_set():
+                    await startup_ready.wait()
+                async with self._slots:
+                    self.waiting -= 1
+                    started = True
+                    metrics.observe('update_wait_seconds', time.monotonic() - queued_at)
+                    self.running += 1
+                    try:
+                        await coroutine
+                    finally:
+                        self.running -= 1
+        finally:
+            if not started:
+                self.waiting -= 1
+                coroutine.close()
+            if key is not None:
+                remaining = self._user_pending[key] - 1
+                if remaining:
+                    self._user_pending[key] = remaining
+                else:
+                    del self._user_pending[key]
+                    self._user_locks.pop(key, None)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+update_processor = PerUserUpdateProcessor(UPDATE_CONCURRENCY, UPDATE_PER_USER_MAX_PENDING)
+
+# ========== STARTUP / SHUTDOWN ==========
+
+async def shutdown_resources(application: Application):
+    """Flushes queued user upserts, releases scale-out locks, then stops the DB executor and pool."""
+    await user_upsert_queue.flush()
+    for lock in (leader_lock, shard_lock):
+        if lock is not None:
+            lock.release()
+    db_executor.shutdown(wait=True)
+    db_pool.closeall()
+
+def record_startup_phase(name, started):
+    elapsed = time.monotonic() - started
+    startup_timings[name] = elapsed
+    logger.info(f"Startup phase '{name}' took {elapsed * 1000:.0f} ms")
+
+async def timed_startup_phase(name, awaitable):
+    started = time.monotonic()
+    try:
+        return await awaitable
+    finally:
+        record_startup_phase(name, started)
+
+def mark_ready():
+    """Opens the handler gate (startup_ready) and logs the total cold-start time."""
+    startup_ready.set()
+    startup_timings['total'] = time.monotonic() - STARTUP_STARTED
+    logger.info(f"✅ Ready {startup_timings['total']:.2f}s after start.")
+
+async def load_ban_list():
+    ban_version = ban_list.version
+    ban_list.replace(await load_banned_user_ids(), ban_version)
+    logger.info(f"Loaded {len(ban_list)} banned users into memory.")
+
+async def warm_up_database():
+    """Schema check first, then the pool, ban list and channel cache warm-ups side by side."""
+    loop = asyncio.get_running_loop()
+    await timed_startup_phase('schema', loop.run_in_executor(db_executor, init_db))
+    await asyncio.gather(
+        timed_startup_phase('db_pool_warm', loop.run_in_executor(db_executor, db_pool.warm, DB_POOL_WARM_SIZE)),
+        timed_startup_phase('ban_list', load_ban_list()),
+        timed_startup_phase('force_sub_channels', get_all_force_sub_channels(return_usernames_only=False)),
+    )
+
+def start_background_jobs(application: Application):
+    """Schedules the repeating jobs once the database is ready."""
+    job_queue = application.job_queue
+    if not job_queue:
+        return
+    job_queue.run_repeating(flush_user_upserts_job, interval=USER_UPSERT_FLUSH_INTERVAL, first=USER_UPSERT_FLUSH_INTERVAL)
+    job_queue.run_repeating(reconcile_ban_list, interval=BAN_LIST_RECONCILE_INTERVAL, first=BAN_LIST_RECONCILE_INTERVAL)
+    if BOT_ROLE == 'worker':
+        job_queue.run_repeating(leader_election_job, interval=LEADER_ELECTION_INTERVAL, first=0)
+    else:
+        start_leader_jobs(job_queue)
+
+async def stop_health_monitor(task):
+    """Stops the health task, then records an idle spin-down while the DB is still open."""
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    if startup_ready.is_set():
+        await health_monitor.record_shutdown()
+
+def stop_signal_event():
+    """Returns an asyncio.Event that SIGINT / SIGTERM will set."""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
             pass
+    return stop_event
+
+async def run_bot(application: Application, webhook_url=None, shared_queue=False):
+    """Runs the bot with /metrics served on PORT next to the webhook route.
+
+    Replaces run_webhook/run_polling so one tornado server can carry both the
+    Telegram webhook and the metrics scrape. Updates arrive through the
+    webhook when `webhook_url` is set, from this worker's shard of the shared
+    queue when `shared_queue` is set, and by polling otherwise.
+
+    The listener is bound before anything else so a cold start answers
+    Telegram right away. Updates then wait in the update processor while the
+    bot initializes and the database warms up in parallel; startup_ready
+    opens the gate.
+    """
+    stop_event = stop_signal_event()
+
+    async def enqueue(update, payload):
+        await application.update_queue.put(update)
+
+    webhook_path = f"/{BOT_TOKEN}" if webhook_url else None
+    if webhook_url and UPDATE_DEDUP_FILE:
+        update_deduplicator.load(UPDATE_DEDUP_FILE)
+    started = time.monotonic()
+    server = build_http_app(webhook_path, application.bot, enqueue).listen(PORT, address="0.0.0.0")
+    record_startup_phase('listen', started)
+    logger.info(f"HTTP server listening on port {PORT} (metrics at {METRICS_PATH})")
+
+    warm_up = asyncio.create_task(warm_up_database())
+    health = asyncio.create_task(health_monitor.run(application.bot, stop_event))
+    consumer = None
+    invalidations = None
+    try:
+        await timed_startup_phase('bot_initialize', application.initialize())
+        await application.start()
+        if webhook_url:
+            await timed_startup_phase('set_webhook', application.bot.set_webhook(url=webhook_url + BOT_TOKEN))
+        elif not shared_queue:
+            await application.updater.start_polling()
+        try:
+            await warm_up
+        except Exception as e:
+            logger.error(f"❌ Database startup failed: {e}")
+            stop_event.set()
+        else:
+            start_background_jobs(application)
+            if shared_queue:
+                invalidations = asyncio.create_task(cache_invalidation_listener.run())
+                consumer = asyncio.create_task(consume_shared_updates(application, stop_event))
+            mark_ready()
+        try:
+            await stop_event.wait()
+        finally:
+            # The platform allows only a few seconds after SIGTERM, so save
+            # what would be lost first: a running broadcast job would
+            # otherwise hold up application.stop() for minutes.
+            shutting_down.set()
+            server.stop()
+            if webhook_url and UPDATE_DEDUP_FILE:
+                update_deduplicator.save(UPDATE_DEDUP_FILE)
+            stop_active_broadcasts()
+            await user_upsert_queue.flush()
+            for task in (consumer, invalidations):
+                if task:
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+            await stop_health_monitor(health)
+            if application.updater.running:
+                await application.updater.stop()
+            if application.running:
+                await application.stop()
+            await shutdown_resources(application)
+    finally:
+        if not warm_up.done():
+            warm_up.cancel()
+        if not health.done():
+            health.cancel()
+        await application.shutdown()
+        server.stop()
+        if webhook_url and UPDATE_DEDUP_FILE:
+            update_deduplicator.save(UPDATE_DEDUP_FILE)
+
+async def run_ingress(application: Application, webhook_url):
+    """Ingress role: sets the webhook and queues every update in update_queue for the workers.
+
+    Registers no handlers and runs no jobs, so it answers Telegram as soon as
+    the row is written. A failed insert returns 500 and Telegram retries.
+    The listener binds first; updates received before the schema check
+    finishes wait on startup_ready.
+    """
+    stop_event = stop_signal_event()
+
+    async def enqueue(update, payload):
+        await startup_ready.wait()
+        await enqueue_shared_update(update.update_id, update_shard(update), payload)
+        metrics.inc('shared_queue_enqueued_total')
+
+    if UPDATE_DEDUP_FILE:
+        update_deduplicator.load(UPDATE_DEDUP_FILE)
+    started = time.monotonic()
+    server = build_http_app(f"/{BOT_TOKEN}", application.bot, enqueue).listen(PORT, address="0.0.0.0")
+    record_startup_phase('listen', started)
+    logger.info(f"Ingress listening on port {PORT}, sharding updates over {WORKER_SHARDS} worker(s).")
+    loop = asyncio.get_running_loop()
+    health = asyncio.create_task(health_monitor.run(application.bot, stop_event))
+    try:
+        await asyncio.gather(
+            timed_startup_phase('bot_initialize', application.bot.initialize()),
+            timed_startup_phase('schema', loop.run_in_executor(db_executor, init_db)),
+        )
+        await timed_startup_phase('set_webhook', application.bot.set_webhook(url=webhook_url + BOT_TOKEN))
+        mark_ready()
+        await stop_event.wait()
+    except Exception as e:
+        logger.error(f"❌ Ingress startup failed: {e}")
+    finally:
+        await stop_health_monitor(health)
+        server.stop()
+        if webhook_tasks:
+            await asyncio.gather(*webhook_tasks, return_exceptions=True)
+        if UPDATE_DEDUP_FILE:
+            update_deduplicator.save(UPDATE_DEDUP_FILE)
+        await application.bot.shutdown()
+        db_executor.shutdown(wait=True)
+        db_pool.closeall()
 
 def main():
-    init_db()
     if not BOT_TOKEN or BOT_TOKEN == "YOUR_TOKEN_HERE":
         logger.error("BOT_TOKEN not set!")
         return
@@ -1311,18 +4334,25 @@ def main():
         logger.error("DATABASE_URL not set! Add your Neon PostgreSQL connection string.")
         return
 
-    application = Application.builder().token(BOT_TOKEN).build()
-    
-    # Test PostgreSQL connection
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT version();')
-        version = cursor.fetchone()
-        logger.info(f"✅ Connected to PostgreSQL: {version[0][:50]}...")
-        conn.close()
-    except Exception as e:
-        logger.error(f"❌ Database connection failed: {e}")
+    if BOT_ROLE not in ('standalone', 'ingress', 'worker'):
+        logger.error(f"Unknown BOT_ROLE {BOT_ROLE!r}; use standalone, ingress or worker.")
+        return
+    if BOT_ROLE == 'worker' and not 0 <= WORKER_SHARD < WORKER_SHARDS:
+        logger.error(f"WORKER_SHARD must be between 0 and {WORKER_SHARDS - 1}.")
+        return
+
+    started = time.monotonic()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(InstrumentedHTTPXRequest(connection_pool_size=256))
+        .concurrent_updates(update_processor)
+        .build()
+    )
+    record_startup_phase('build_application', started)
+
+    if BOT_ROLE == 'ingress':
+        asyncio.run(run_ingress(application, WEBHOOK_URL))
         return
     
     if os.path.exists('restart_message.json'):
@@ -1336,6 +4366,7 @@ def main():
             message_id_to_copy = restart_info.get('message_id_to_copy') 
 
             async def post_restart_notification(context: ContextTypes.DEFAULT_TYPE):
+                await startup_ready.wait()
                 try:
                     await context.bot.send_message(
                         chat_id=original_chat_id, 
@@ -1381,35 +4412,27 @@ def main():
         except Exception as e:
             logger.error(f"Error processing restart_message.json: {e}")
     
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CallbackQueryHandler(button_handler))
+    application.add_handler(CommandHandler("start", instrument_handler(start)))
+    application.add_handler(CallbackQueryHandler(instrument_handler(button_handler)))
     
     admin_filter = filters.User(user_id=ADMIN_ID)
-    application.add_handler(CommandHandler("reload", reload_command, filters=admin_filter))
-    application.add_handler(CommandHandler("stats", stats_command, filters=admin_filter)) 
-    application.add_handler(CommandHandler("addchannel", add_channel_command, filters=admin_filter))
-    application.add_handler(CommandHandler("removechannel", remove_channel_command, filters=admin_filter))
-    application.add_handler(CommandHandler("banuser", ban_user_command, filters=admin_filter))
-    application.add_handler(CommandHandler("unbanuser", unban_user_command, filters=admin_filter))
+    application.add_handler(CommandHandler("reload", instrument_handler(reload_command), filters=admin_filter))
+    application.add_handler(CommandHandler("stats", instrument_handler(stats_command), filters=admin_filter)) 
+    application.add_handler(CommandHandler("addchannel", instrument_handler(add_channel_command), filters=admin_filter))
+    application.add_handler(CommandHandler("removechannel", instrument_handler(remove_channel_command), filters=admin_filter))
+    application.add_handler(CommandHandler("banuser", instrument_handler(ban_user_command), filters=admin_filter))
+    application.add_handler(CommandHandler("unbanuser", instrument_handler(unban_user_command), filters=admin_filter))
     
-    application.add_handler(MessageHandler(admin_filter & ~filters.COMMAND, handle_admin_message))
+    application.add_handler(MessageHandler(admin_filter & ~filters.COMMAND, instrument_handler(handle_admin_message)))
     
     application.add_error_handler(error_handler)
 
-    if application.job_queue:
-        application.job_queue.run_repeating(cleanup_task, interval=600, first=10)
-
-    if WEBHOOK_URL and BOT_TOKEN:
-        keep_alive_thread = Thread(target=keep_alive, daemon=True)
-        keep_alive_thread.start()
-        application.run_webhook(
-            listen="0.0.0.0",
-            port=PORT,
-            url_path=BOT_TOKEN,
-            webhook_url=WEBHOOK_URL + BOT_TOKEN
-        )
+    if BOT_ROLE == 'worker':
+        asyncio.run(run_bot(application, shared_queue=True))
+    elif WEBHOOK_URL and BOT_TOKEN:
+        asyncio.run(run_bot(application, webhook_url=WEBHOOK_URL))
     else:
-        application.run_polling()
+        asyncio.run(run_bot(application))
 
 if __name__ == "__main__":
     main()